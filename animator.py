@@ -1,8 +1,12 @@
 import random, math, time, sys
+import numpy as np
 import pygame
 import pygame.font
 from traffic_grid import *
 from constants import *
+from binary_trace import TraceReplay
+from pose_engine import TrajectoryPack, IntersectionLoad, car_outlines
+from spatial_index import UniformGrid
 
 # Animator basics: (everything is in meters)
 # lane width: 3.7  (us road lane width)
@@ -11,6 +15,18 @@ from constants import *
 #     medium 1.9 x 4.7
 #     large: 2.4 x 8.4  (Large truck)
 
+# Spatial index of the intersections (see viewport): cell size, and how far from its position an
+# intersection or car can be drawn
+INTERSECTION_CELL_SIZE = 400
+ISEC_EXTENT = ISEC_SIZE + ZEBRA_WIDTH + QZONE_LEN + SZONE_LEN
+CAR_EXTENT = 5
+
+# Zoomed out below LOD_SCALE pixels per meter, cars are not drawn one by one but as a
+# heatmap of the cars around each intersection (IntersectionLoad): its area is colored
+# from blue to red up to HEATMAP_FULL cars, and a white disc grows with its queue
+LOD_SCALE = 0.5
+HEATMAP_FULL = 25
+
 
 
 def transform(xy, tr):
@@ -35,39 +51,53 @@ def distance(x, y):
     return math.sqrt(x*x+y*y)
 
 
+# Looks of a car, drawn from its own cid so that it is the same in every frame exporter
 class Car:
     def __init__(self, cid):
         self.cid = cid
+        rng = random.Random(cid)
         # Figure out what type of cars we have here
-        r = random.random()
+        r = rng.random()
         acc = 0
         for prob, data in CAR_DIMENSIONS:
             acc += prob
             if r >= acc:
                 continue
             self.width, self.length = data
-        self.color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        self.color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
         self.polylines = CAR_POLYLINES
 
 
+# traffic_grid is a TrafficGrid that ran with a Choreographer, or a TraceReplay
 class Animator:
-    def __init__(self, traffic_grid):
+    def __init__(self, traffic_grid, screen_size=(900, 900)):
         self.canvas_size = 1200.0  # In meters
         self.traffic_grid = traffic_grid
-        self.cars = []
+        self.cars = {}  # cid => Car, created when the car is first drawn
+        self.pack = None  # TrajectoryPack of the choreographer drawn
+        self.intersection_index = None  # UniformGrid of the IIDs of the intersections
+        self.load = None  # IntersectionLoad of the pack, made when first zoomed out
+        self.half_widths = None  # Car sizes and colors in the order of the pack
+        self.half_lengths = None
+        self.colors = None
         self.disp = None
+        self.static_layer = None  # Surface with the roads, drawn for static_key
+        self.static_key = None  # (screen_scale, screen_offset, screen_size)
         self.font = None
         self.t0 = 0
-        self.screen_size = (900, 900)
+        self.time_offset = 0  # Simulated time shown at t0, moved with the arrow keys
+        self.screen_size = screen_size
         self.screen_offset = (0, 0)
         self.screen_scale = self.screen_size[0] / self.canvas_size  # Each pixel == ? meters
 
-        self.setup_cars()
+        if isinstance(traffic_grid, TraceReplay):
+            self.time_offset = traffic_grid.start_time()
         self.init_pygame()
 
-    def setup_cars(self):
-        for cid in self.traffic_grid.choreographer.cars.keys():
-            self.cars.append(Car(cid))
+    def choreographer_at(self, t):
+        if isinstance(self.traffic_grid, TraceReplay):
+            return self.traffic_grid.window_at(t)
+        return self.traffic_grid.choreographer
 
     def init_pygame(self):
         pygame.init()
@@ -76,7 +106,7 @@ class Animator:
         self.disp = pygame.display.set_mode(self.screen_size, 0, 32)
         self.t0 = time.time()
 
-    def draw_dx_line(self, x, y0, y1):
+    def draw_dx_line(self, surface, x, y0, y1):
         ss = self.screen_scale
         lw = round(ss * 0.2)
         if lw < 1:
@@ -85,11 +115,11 @@ class Animator:
             dx = (x + s * LANE_WIDTH * 0.25) * ss - self.screen_offset[0] + self.screen_size[0] / 2
             dy0 = y0 * ss - self.screen_offset[1] + self.screen_size[1] / 2
             dy1 = y1 * ss - self.screen_offset[1] + self.screen_size[1] / 2
-            pygame.draw.line(self.disp, COLOR_YELLOW, (dx, dy0), (dx, dy1), lw)
+            pygame.draw.line(surface, COLOR_YELLOW, (dx, dy0), (dx, dy1), lw)
             dx = (x + s * LANE_WIDTH * 1.5) * ss - self.screen_offset[0] + self.screen_size[0] / 2
-            pygame.draw.line(self.disp, COLOR_WHITE, (dx, dy0), (dx, dy1), lw)
+            pygame.draw.line(surface, COLOR_WHITE, (dx, dy0), (dx, dy1), lw)
 
-    def draw_dy_line(self, x0, x1, y):
+    def draw_dy_line(self, surface, x0, x1, y):
         ss = self.screen_scale
         lw = round(ss * 0.2)
         if lw < 1:
@@ -98,26 +128,26 @@ class Animator:
             dy = (y + s * LANE_WIDTH * 0.25) * ss - self.screen_offset[1] + self.screen_size[1] / 2
             dx0 = x0 * ss - self.screen_offset[0] + self.screen_size[0] / 2
             dx1 = x1 * ss - self.screen_offset[0] + self.screen_size[0] / 2
-            pygame.draw.line(self.disp, COLOR_YELLOW, (dx0, dy), (dx1, dy), lw)
+            pygame.draw.line(surface, COLOR_YELLOW, (dx0, dy), (dx1, dy), lw)
             dy = (y + s * LANE_WIDTH * 1.5) * ss - self.screen_offset[1] + self.screen_size[1] / 2
-            pygame.draw.line(self.disp, COLOR_WHITE, (dx0, dy), (dx1, dy), lw)
+            pygame.draw.line(surface, COLOR_WHITE, (dx0, dy), (dx1, dy), lw)
 
-    def draw_d_lines(self, a, b1, b2):
-        self.draw_dx_line(a, b1, b2)
-        self.draw_dy_line(b1, b2, a)
+    def draw_d_lines(self, surface, a, b1, b2):
+        self.draw_dx_line(surface, a, b1, b2)
+        self.draw_dy_line(surface, b1, b2, a)
 
-    def draw_grid(self):
+    def draw_grid(self, surface):
         # TODO: This is hard coded for now, should be following intersections
         for i in [-1, 0, 1]:
             md = 400 * i
             bc = -600
             for j in [-1, 0, 1]:
                 bd = j * 400
-                self.draw_d_lines(md, bc, bd - ISEC_SIZE - ZEBRA_WIDTH - QZONE_LEN - SZONE_LEN)
+                self.draw_d_lines(surface, md, bc, bd - ISEC_SIZE - ZEBRA_WIDTH - QZONE_LEN - SZONE_LEN)
                 bc = bd + ISEC_SIZE + ZEBRA_WIDTH + QZONE_LEN + SZONE_LEN
-            self.draw_d_lines(md, bc, 600)
+            self.draw_d_lines(surface, md, bc, 600)
 
-    def draw_intersection(self, io, t):
+    def draw_intersection(self, surface, io, t):
         ss = self.screen_scale
         tr = [ss, ss, io.pos_x * ss - self.screen_offset[0] + self.screen_size[0] / 2,
               io.pos_y * ss - self.screen_offset[1] + self.screen_size[1] / 2, 0]
@@ -127,41 +157,121 @@ class Animator:
             lw = 1
         for shp in CS_WHITES:
             td_shp = list(map(lambda xy: transform(xy, tr), shp))
-            pygame.draw.lines(self.disp, COLOR_WHITE, False, td_shp, lw)
+            pygame.draw.lines(surface, COLOR_WHITE, False, td_shp, lw)
         for shp in CS_YELLOW:
             td_shp = list(map(lambda xy: transform(xy, tr), shp))
-            pygame.draw.lines(self.disp, COLOR_YELLOW, False, td_shp, lw)
+            pygame.draw.lines(surface, COLOR_YELLOW, False, td_shp, lw)
         for shp in CS_DOTTED:
             td_shp = list(map(lambda xy: transform(xy, tr), shp))
-            pygame.draw.lines(self.disp, COLOR_HALF_WHITE, False, td_shp, lw)
-
-    def draw_intersections(self, t):
-        for isec in self.traffic_grid.intersections:
-            if not isec or isec.is_inlet():
-                continue
-            self.draw_intersection(isec, t)
+            pygame.draw.lines(surface, COLOR_HALF_WHITE, False, td_shp, lw)
+
+    def draw_intersections(self, surface, t):
+        if self.intersection_index is None:
+            self.index_intersections()
+        ios = self.traffic_grid.intersections
+        x0, y0, x1, y1 = self.viewport(ISEC_EXTENT)
+        for iid in self.intersection_index.query(x0, y0, x1, y1).tolist():
+            self.draw_intersection(surface, ios[iid], t)
+
+    def index_intersections(self):
+        ios = [io for io in self.traffic_grid.intersections if io and not io.is_inlet()]
+        x = [io.pos_x for io in ios]
+        y = [io.pos_y for io in ios]
+        self.intersection_index = UniformGrid(x, y, x, y, [io.iid for io in ios],
+                                              INTERSECTION_CELL_SIZE)
+
+    # Rectangle of the plane on screen (min_x, min_y, max_x, max_y), in meters, widened
+    # by margin on every side
+    def viewport(self, margin=0):
+        ss = self.screen_scale
+        x0 = (self.screen_offset[0] - self.screen_size[0] / 2) / ss
+        y0 = (self.screen_offset[1] - self.screen_size[1] / 2) / ss
+        return (x0 - margin, y0 - margin, x0 + self.screen_size[0] / ss + margin,
+                y0 + self.screen_size[1] / ss + margin)
 
     def draw_cars(self, t):
-        for car in self.cars:
-            self.draw_car(t, car)
-
-    def draw_car(self, t, car):
-        info = self.traffic_grid.choreographer.car_info(car.cid, t)
-        if info is None:
-            return  # No more drawing
+        self.update_pack(t)
+        if not len(self.pack):
+            return
+        x0, y0, x1, y1 = self.viewport(CAR_EXTENT)
+        index, x, y, angle = self.pack.poses(t, self.pack.cars_in(x0, y0, x1, y1, t))
+        on_screen = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        if not on_screen.all():
+            index, x, y, angle = index[on_screen], x[on_screen], y[on_screen], angle[on_screen]
+        ss = self.screen_scale
+        screen_x = x * ss - self.screen_offset[0] + self.screen_size[0] / 2
+        screen_y = y * ss - self.screen_offset[1] + self.screen_size[1] / 2
+        outlines = car_outlines(self.half_widths[index] * ss, self.half_lengths[index] * ss,
+                                screen_x, screen_y, angle)
+        colors = self.colors
+        disp = self.disp
+        for k, points in zip(index.tolist(), outlines.transpose(0, 2, 1).tolist()):
+            pygame.draw.lines(disp, colors[k], True, points, 1)
+
+    def draw_heatmap(self, t):
+        self.update_pack(t)
+        if self.load is None:
+            self.load = IntersectionLoad(self.pack, len(self.traffic_grid.intersections))
+        if self.intersection_index is None:
+            self.index_intersections()
+        density, queued = self.load.at(t)
+        ios = self.traffic_grid.intersections
         ss = self.screen_scale
-        tr = (car.width / 2 * ss, car.length / 2 * ss, info[0] * ss - self.screen_offset[0] + self.screen_size[0] / 2,
-              info[1] * ss - self.screen_offset[1] + self.screen_size[1] / 2, info[2])
-        # First determine location and orientation
-        points = list(map(lambda xy: transform(xy, tr), car.polylines))
-        pygame.draw.lines(self.disp, car.color, True, points, 1)
+        r = max(ISEC_EXTENT * ss, 1)
+        x0, y0, x1, y1 = self.viewport(ISEC_EXTENT)
+        for iid in self.intersection_index.query(x0, y0, x1, y1).tolist():
+            n = density[iid]
+            if n <= 0:
+                continue
+            io = ios[iid]
+            sx = io.pos_x * ss - self.screen_offset[0] + self.screen_size[0] / 2
+            sy = io.pos_y * ss - self.screen_offset[1] + self.screen_size[1] / 2
+            h = min(n / HEATMAP_FULL, 1)
+            pygame.draw.rect(self.disp, (round(255 * h), 0, round(255 * (1 - h))),
+                             (sx - r, sy - r, 2 * r, 2 * r))
+            if queued[iid] > 0:
+                pygame.draw.circle(self.disp, COLOR_WHITE, (sx, sy),
+                                   max(r * math.sqrt(min(queued[iid] / HEATMAP_FULL, 1)), 1))
+
+    def update_pack(self, t):
+        choreographer = self.choreographer_at(t)
+        if self.pack is None or self.pack.choreographer is not choreographer:
+            self.pack_cars(choreographer)
+
+    def pack_cars(self, choreographer):
+        pack = self.pack = TrajectoryPack(choreographer)
+        self.load = None
+        cars = []
+        for cid in pack.cids.tolist():
+            car = self.cars.get(cid)
+            if car is None:
+                car = self.cars[cid] = Car(cid)
+            cars.append(car)
+        self.half_widths = np.array([car.width / 2 for car in cars])
+        self.half_lengths = np.array([car.length / 2 for car in cars])
+        self.colors = [car.color for car in cars]
 
     def draw(self, t):
-        self.draw_grid()
-        self.draw_intersections(t)
-        self.draw_cars(t)
+        self.draw_static_layer(t)
+        if self.screen_scale < LOD_SCALE:
+            self.draw_heatmap(t)
+        else:
+            self.draw_cars(t)
         self.draw_texts()
 
+    # Roads and intersections don't change, they are drawn once to an off-screen surface
+    # and redrawn only when the view moves (drag, zoom)
+    def draw_static_layer(self, t):
+        key = (self.screen_scale, self.screen_offset, self.screen_size)
+        if self.static_key != key:
+            if self.static_layer is None or self.static_layer.get_size() != self.screen_size:
+                self.static_layer = pygame.Surface(self.screen_size).convert()
+            self.static_layer.fill((0, 0, 0))
+            self.draw_grid(self.static_layer)
+            self.draw_intersections(self.static_layer, t)
+            self.static_key = key
+        self.disp.blit(self.static_layer, (0, 0))
+
     def draw_texts(self):
         pass
         # text = self.font.render("{}, {}".format(*self.screen_offset), False, (255,255,255))
@@ -183,10 +293,16 @@ class Animator:
                         self.zoom_in()
                     elif evt.button == 5:  # scroll down
                         self.zoom_out()
+                elif evt.type == pygame.KEYDOWN:
+                    # Scrub through the run, a minute (10 with shift) at a time
+                    step = 600 if evt.mod & pygame.KMOD_SHIFT else 60
+                    if evt.key == pygame.K_RIGHT:
+                        self.time_offset += step
+                    elif evt.key == pygame.K_LEFT:
+                        self.time_offset -= step
 
             # Draw the scene
-            self.disp.fill((0, 0, 0))
-            t = (time.time() - self.t0) * 3
+            t = self.time_offset + (time.time() - self.t0) * 3
             self.draw(t)
 
             pygame.display.update()
@@ -236,6 +352,10 @@ class Animator:
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # python animator.py trace.bin replays a trace written by TraceWriter
+        Animator(TraceReplay(sys.argv[1])).event_loop()
+        sys.exit()
     tr = TrafficGrid()
     tr.choreographer = Choreographer(tr)
     tr.generate_grid(3, 3)
@@ -0,0 +1,96 @@
+import math
+from bisect import bisect_right
+from random_streams import RNG_ARRIVAL, RNG_INLET
+
+# Arrival processes feeding cars into a TrafficGrid (see TrafficGrid.add_arrivals).
+# A process is an iterable of (ts, cid, to_iid, to_dir) in time order; the grid only
+# asks for the next arrival when the previous one has entered, so the event queue
+# holds one pending arrival per process instead of every car of the run.
+#
+# Gap distributions are called as gaps(rng, cid, t) and return the time between the
+# previous arrival (at t) and the arrival of car cid.
+
+
+# Integer gap drawn uniformly from 0..max_gap (the original Statistics demand)
+class UniformGaps:
+    def __init__(self, max_gap):
+        self.max_gap = max_gap
+
+    def __call__(self, rng, cid, t):
+        return rng.randint(RNG_ARRIVAL, cid, 0, self.max_gap)
+
+
+# Poisson arrivals with the given mean gap. With a DemandProfile the rate is
+# multiplied by the profile factor at the arrival time (non-homogeneous Poisson
+# process, sampled by thinning).
+class ExponentialGaps:
+    def __init__(self, mean_gap, profile=None):
+        self.mean_gap = mean_gap
+        self.profile = profile
+
+    def __call__(self, rng, cid, t):
+        if self.profile is None:
+            return -self.mean_gap * math.log(1.0 - rng.random(RNG_ARRIVAL, cid))
+        peak = self.profile.peak
+        t1 = t
+        while True:
+            t1 += -self.mean_gap / peak * math.log(1.0 - rng.random(RNG_ARRIVAL, cid))
+            if rng.random(RNG_ARRIVAL, cid) * peak <= self.profile.factor(t1):
+                return t1 - t
+
+
+# Piecewise constant demand multiplier, e.g. [(0, 1.0), (7 * 3600, 2.5), (9 * 3600, 1.0)]
+# for a morning rush hour. With a period the profile repeats (86400 for daily demand).
+class DemandProfile:
+    def __init__(self, steps, period=None):
+        self.starts = [t for t, factor in steps]
+        self.factors = [factor for t, factor in steps]
+        self.period = period
+        self.peak = max(self.factors)
+
+    def factor(self, t):
+        if self.period:
+            t %= self.period
+        i = bisect_right(self.starts, t) - 1
+        return self.factors[i] if i >= 0 else self.factors[0]
+
+
+# One process for the whole grid: car i arrives a gap after car i - 1 at a randomly
+# chosen inlet. Timestamps are rounded to whole seconds.
+class MergedArrivals:
+    def __init__(self, inlets, num_cars, gaps, rng, start=0, first_cid=0):
+        self.inlets = inlets
+        self.num_cars = num_cars
+        self.gaps = gaps
+        self.rng = rng
+        self.start = start
+        self.first_cid = first_cid
+
+    def __iter__(self):
+        t = self.start
+        for cid in range(self.first_cid, self.first_cid + self.num_cars):
+            t += self.gaps(self.rng, cid, t)
+            inlet = self.rng.choice(RNG_INLET, cid, self.inlets)
+            yield round(t), cid, inlet.to_iid, inlet.to_dir
+
+
+# Arrivals at a single inlet, until the given time (or forever). Car ids come from
+# cids, an iterator shared by all the inlets of a grid (e.g. itertools.count()).
+class InletArrivals:
+    def __init__(self, inlet, gaps, rng, cids, until=None, start=0):
+        self.inlet = inlet
+        self.gaps = gaps
+        self.rng = rng
+        self.cids = cids
+        self.until = until
+        self.start = start
+
+    def __iter__(self):
+        t = self.start
+        while True:
+            cid = next(self.cids)
+            t += self.gaps(self.rng, cid, t)
+            if self.until is not None and t >= self.until:
+                self.rng.forget(cid)  # This car never comes
+                return
+            yield round(t), cid, self.inlet.to_iid, self.inlet.to_dir
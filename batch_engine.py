@@ -0,0 +1,281 @@
+import numpy as np
+from light_state import LightState, LightState1, CYCLE_PHASES
+from routing import compile_mesh
+from traffic_grid import (Intersection, Statistics, STANDARD_4WAY_MESH, TS_FIRST_DEQUEUE_DELAY,
+                          TS_NEXT_DEQUEUE_DELAY, grid_layout, grid_neighbours)
+
+# Runs many replications of the same grid in lockstep, one NumPy step per simulated
+# second for all of them, instead of one Python call per event and replication.
+#
+# The model is the one of TrafficGrid with the same topology (grid_layout), routing
+# mesh and light cycle (CYCLE_PHASES). Within a second events are handled in the same
+# order as the event loop: cars entering, then light changes, then dequeues. Cars are
+# anonymous, only counts of cars travelling and the stop times of queued cars are kept.
+# Differences with TrafficGrid:
+#   - Only fixed cycle lights (see LIGHT_START_RANGES), LightState2 decides car by car
+#   - Routes with a probability to stop (p_stop > 0) are not supported
+#   - A replication stops at the end of the second its num_cars-th car left the grid
+#   - Random numbers come from a NumPy generator, results are statistically equivalent
+#     to TrafficGrid's, not identical
+
+# Fixed cycle light classes => range of the random cycle start (see their __init__)
+LIGHT_START_RANGES = {
+    LightState: (0, 0),
+    LightState1: (-100, 0),
+}
+
+
+# Smallest power of 2 above n, ring sizes
+def ring_size(n):
+    size = 1
+    while size <= n:
+        size <<= 1
+    return size
+
+
+# Position of every element among the equal keys before it, e.g. [7, 3, 7, 7] => [0, 0, 1, 2]
+def group_ranks(keys):
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    idx = np.arange(len(keys))
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = np.maximum.accumulate(np.where(starts, idx, 0))
+    ranks = np.empty(len(keys), dtype=np.int64)
+    ranks[order] = idx - first
+    return ranks
+
+
+# Runs replicas replications of a grid_size x grid_size grid. car_density is a number or
+# one number per replica, e.g. for a parameter sweep.
+class BatchEngine:
+    def __init__(self, grid_size, num_cars, car_density, replicas, light_state_class=LightState1,
+                 mesh=STANDARD_4WAY_MESH, seed=None):
+        if light_state_class not in LIGHT_START_RANGES:
+            raise ValueError("BatchEngine only runs fixed cycle lights, not {}"
+                             .format(light_state_class.__name__))
+        self.mesh = compile_mesh(mesh)
+        if any(route.p_stop > 0 for route in self.mesh):
+            raise ValueError("BatchEngine does not support routes with p_stop > 0")
+        if any(route.travel_time < 1 for route in self.mesh):
+            raise ValueError("BatchEngine needs travel times of at least 1")
+        self.grid_size = grid_size
+        self.num_cars = num_cars
+        self.replicas = replicas
+        self.car_density = np.broadcast_to(np.asarray(car_density, dtype=np.int64), (replicas,))
+        self.light_state_class = light_state_class
+        self.rng = np.random.default_rng(seed)
+
+        # Topology, intersections numbered 0..n-1 in IID order. A car on its way is kept
+        # as its destination: intersection * 4 + incoming direction, or n * 4 when it
+        # is leaving the grid through an inlet.
+        m = grid_size
+        numbers = {}
+        neighbours = []
+        inlets = []
+        for iid, pos_x, pos_y, to_iid, d in grid_layout(m, m):
+            if to_iid is None:
+                numbers[iid] = len(neighbours)
+                neighbours.append(grid_neighbours(iid, m))
+            else:
+                inlets.append((to_iid, d))
+        self.n_intersections = n = len(neighbours)
+        self.exit_dest = 4 * n
+        # Destination when leaving intersection x towards direction to_d
+        self.next_dest = np.array([[numbers[nb_iid] * 4 + Intersection.to_dir_lookup[to_d]
+                                    if nb_iid in numbers else self.exit_dest
+                                    for to_d, nb_iid in enumerate(nbs)] for nbs in neighbours],
+                                  dtype=np.int64)
+        self.inlet_dest = np.array([numbers[to_iid] * 4 + d for to_iid, d in inlets],
+                                   dtype=np.int64)
+
+        # Routing: for every incoming direction the cumulative probabilities (padded with
+        # 2.0, never drawn) and the qid of each route
+        n_routes = max(len(self.mesh.route_tables[d][1]) for d in range(4))
+        self.cumulative = np.full((4, n_routes), 2.0)
+        self.route_qid = np.zeros((4, n_routes), dtype=np.int64)
+        self.n_routes = np.zeros(4, dtype=np.int64)
+        for d, (cumulative, routes) in enumerate(self.mesh.route_tables):
+            self.n_routes[d] = len(routes)
+            self.cumulative[d, :len(routes)] = cumulative
+            self.route_qid[d, :len(routes)] = [route.qid for route in routes]
+        self.travel_time = np.zeros(16, dtype=np.int64)  # Per qid
+        self.has_route = np.zeros(16, dtype=bool)
+        for route in self.mesh:
+            self.travel_time[route.qid] = route.travel_time
+            self.has_route[route.qid] = True
+
+        # Light cycle: red per phase and qid, phase durations
+        phases = np.array(CYCLE_PHASES, dtype=np.int64)
+        self.red = phases[:, np.arange(16) % 8].astype(bool)
+        self.duration = phases[:, 8]
+
+    # Returns the average wait time of every replica
+    def run(self):
+        K = self.replicas
+        n = self.n_intersections
+        rng = self.rng
+        n_phases = len(self.duration)
+        # Flat indexes: replica * n_dests + destination for cars on their way,
+        # (replica * n + intersection) * 16 + qid for queues, replica * n + intersection
+        # for lights
+        n_dests = self.exit_dest + 1
+        n_lights = K * n
+
+        # Arrivals, drawn for the whole run at once and sorted by time
+        gaps = rng.integers(0, self.car_density[:, None] + 1, size=(K, self.num_cars))
+        arrival_ts = np.cumsum(gaps, axis=1).ravel()
+        inlet = rng.integers(0, len(self.inlet_dest), size=K * self.num_cars)
+        arrival_car = np.repeat(np.arange(K), self.num_cars) * n_dests + self.inlet_dest[inlet]
+        order = np.argsort(arrival_ts, kind='stable')
+        arrival_ts = arrival_ts[order]
+        arrival_car = arrival_car[order]
+        next_arrival = 0
+
+        # Cars on their way, one entry per car, in a ring of lists indexed by arrival time
+        travelling = [[] for i in range(ring_size(int(self.travel_time.max())))]
+        travel_mask = len(travelling) - 1
+
+        # Queues: ring buffers of stop times, grown on demand
+        capacity = 16
+        queue_ts = np.zeros((n_lights * 16, capacity), dtype=np.int64)
+        queue_head = np.zeros(n_lights * 16, dtype=np.int64)
+        queue_len = np.zeros(n_lights * 16, dtype=np.int64)
+        # Pending dequeues, one entry per event, in a ring of lists like travelling
+        dequeues = [[] for i in range(ring_size(max(TS_FIRST_DEQUEUE_DELAY, TS_NEXT_DEQUEUE_DELAY)))]
+        dequeue_mask = len(dequeues) - 1
+
+        # Lights: current phase, next change and the phase it changes to
+        state = np.zeros(n_lights, dtype=np.int64)
+        low, high = LIGHT_START_RANGES[self.light_state_class]
+        next_change = rng.integers(low, high + 1, size=n_lights) + self.duration[0]
+        to_state = np.ones(n_lights, dtype=np.int64)
+
+        total_wait = np.zeros(K, dtype=np.int64)
+        count_waited = np.zeros(K, dtype=np.int64)
+        exited = np.zeros(K, dtype=np.int64)
+        average_wait = np.full(K, np.nan)
+        running = np.ones(K, dtype=bool)
+
+        t = min(0, int(next_change.min()))
+        while running.any():
+            # New cars
+            end = np.searchsorted(arrival_ts, t, side='right')
+            if end > next_arrival:
+                travelling[t & travel_mask].append(arrival_car[next_arrival:end])
+                next_arrival = end
+
+            # Cars entering an intersection (or leaving the grid)
+            arriving = travelling[t & travel_mask]
+            if arriving:
+                cars = np.concatenate(arriving)
+                arriving.clear()
+                replica = cars // n_dests
+                dest = cars % n_dests
+                leaving = dest == self.exit_dest
+                exited += np.bincount(replica[leaving], minlength=K)
+                light = replica[~leaving] * n + dest[~leaving] // 4
+                d = dest[~leaving] % 4
+                # Route drawn like Intersection.incoming_traffic (bisect_right)
+                u = rng.random(len(d))
+                j = np.minimum((u[:, None] >= self.cumulative[d]).sum(axis=1), self.n_routes[d] - 1)
+                qid = self.route_qid[d, j]
+                queue = light * 16 + qid
+                stops = self.red[state[light], qid] | (queue_len[queue] > 0)
+                # Cars stopping, in the same second they all get the same stop time
+                stopping = queue[stops]
+                if len(stopping):
+                    pos = queue_len[stopping] + group_ranks(stopping)
+                    if pos.max() >= capacity:
+                        queue_ts, queue_head, capacity = self.grow(queue_ts, queue_head, capacity,
+                                                                   int(pos.max()) + 1)
+                    queue_ts[stopping, (queue_head[stopping] + pos) & (capacity - 1)] = t
+                    np.add.at(queue_len, stopping, 1)
+                # Cars going through
+                passing = ~stops
+                count_waited += np.bincount(light[passing] // n, minlength=K)
+                self.travel(travelling, t, light[passing], qid[passing])
+
+            # Light changes
+            changing = np.flatnonzero(next_change == t)
+            if len(changing):
+                state[changing] = to_state[changing]
+                phase = state[changing]
+                next_change[changing] = t + self.duration[phase]
+                to_state[changing] = (phase + 1) % n_phases
+                # Every green queue with cars starts letting them go
+                queue = changing[:, None] * 16 + np.arange(16)
+                starts = ~self.red[phase] & self.has_route & (queue_len[queue] > 0)
+                if starts.any():
+                    dequeues[(t + TS_FIRST_DEQUEUE_DELAY) & dequeue_mask].append(queue[starts])
+
+            # Dequeues: each lets the head car go and schedules the next one while cars
+            # are left, several in the same second act one after the other
+            pending = dequeues[t & dequeue_mask]
+            if pending:
+                queue, events = np.unique(np.concatenate(pending), return_counts=True)
+                pending.clear()
+                waiting = queue_len[queue]
+                popped = np.minimum(events, waiting)
+                follow = np.maximum(np.minimum(events, waiting - 1), 0)
+                if follow.any():
+                    dequeues[(t + TS_NEXT_DEQUEUE_DELAY) & dequeue_mask].append(
+                        np.repeat(queue, follow))
+                queue = queue[popped > 0]
+                popped = popped[popped > 0]
+                if len(queue):
+                    cars = np.repeat(queue, popped)
+                    offsets = np.arange(len(cars)) - np.repeat(np.cumsum(popped) - popped, popped)
+                    waits = t - queue_ts[cars, (queue_head[cars] + offsets) & (capacity - 1)]
+                    replica = cars // (n * 16)
+                    total_wait += np.bincount(replica, waits, K).astype(np.int64)
+                    count_waited += np.bincount(replica, minlength=K)
+                    queue_head[queue] = (queue_head[queue] + popped) & (capacity - 1)
+                    queue_len[queue] -= popped
+                    self.travel(travelling, t, cars // 16, cars % 16)
+
+            finished = running & (exited >= self.num_cars)
+            if finished.any():
+                average_wait[finished] = total_wait[finished] / count_waited[finished]
+                running &= ~finished
+            t += 1
+        return average_wait
+
+    # Sends cars from the lights (flat replica * n + intersection) along qid
+    def travel(self, travelling, t, light, qid):
+        n = self.n_intersections
+        dest = self.next_dest[light % n, qid % 4]
+        car = light // n * (self.exit_dest + 1) + dest
+        arrival = t + self.travel_time[qid]
+        travel_mask = len(travelling) - 1
+        for ts in np.unique(arrival):
+            travelling[ts & travel_mask].append(car[arrival == ts])
+
+    # Doubles the queue buffers until need fits, with every queue starting at index 0
+    def grow(self, queue_ts, queue_head, capacity, need):
+        new_capacity = capacity
+        while new_capacity < need:
+            new_capacity <<= 1
+        idx = (queue_head[:, None] + np.arange(capacity)) & (capacity - 1)
+        grown = np.zeros((len(queue_ts), new_capacity), dtype=np.int64)
+        grown[:, :capacity] = np.take_along_axis(queue_ts, idx, axis=1)
+        return grown, np.zeros_like(queue_head), new_capacity
+
+
+# Statistics running all of its replications in a single BatchEngine, same parameters
+# and report
+class BatchStatistics(Statistics):
+    light_state_class = LightState1  # BatchEngine needs a fixed cycle light
+
+    def test(self):
+        engine = BatchEngine(self.grid_size, self.num_cars, self.car_density,
+                             self.list_number - self.counter, self.light_state_class,
+                             seed=self.seed)
+        for average_wait_time in engine.run():
+            self.add_result(float(average_wait_time))
+        self.report()
+
+
+if __name__ == "__main__":
+    s = BatchStatistics()
+    s.test()
@@ -0,0 +1,77 @@
+import random
+import sys
+import time
+from traffic_grid import TrafficGrid, EV_ALL_STOP
+from arrivals import MergedArrivals, UniformGaps
+from event_queue import HeapEventQueue, CalendarEventQueue
+from instrumentation import EventLoopProfiler
+
+# Measures event throughput of TrafficGrid.event_loop on growing grids.
+# Every run is cut off at the same simulated time, so larger grids process more
+# events in the same time span.
+# Usage: python benchmark.py [--calendar] [--profile] [num_cars] [grid sizes...]
+# --profile also prints an EventLoopProfiler report per grid (slows the loop down)
+
+GRID_SIZES = [3, 20, 100]
+NUM_CARS = 2000
+HORIZON = 2000  # Simulated seconds per run
+CAR_DENSITY = 10
+
+
+def count_events(tr):
+    # Wrap every handler so dispatched events can be counted
+    counter = [0]
+
+    def wrap(fn):
+        def counted(ts, payload):
+            counter[0] += 1
+            return fn(ts, payload)
+        return counted
+
+    for ev_type, fn in tr.event_handlers.items():
+        if fn is not None:
+            tr.event_handlers[ev_type] = wrap(fn)
+    return counter
+
+
+def run(grid_size, num_cars, car_density=CAR_DENSITY, horizon=HORIZON, seed=1,
+        event_queue=HeapEventQueue, profiler=None):
+    random.seed(seed)
+    tr = TrafficGrid(num_cars, False, event_queue=event_queue())
+    tr.profiler = profiler
+    t0 = time.perf_counter()
+    tr.generate_grid(grid_size, grid_size)
+    setup = time.perf_counter() - t0
+
+    # Cars come from lazy arrival processes as in Statistics.simulate, one pending
+    # arrival at a time, so the loop also measures drawing and scheduling them
+    tr.add_arrivals(MergedArrivals(tr.inlets, num_cars, UniformGaps(car_density), tr.rng))
+    tr.add_event(EV_ALL_STOP, horizon, True, None)
+
+    counter = count_events(tr)
+    t0 = time.perf_counter()
+    tr.event_loop()
+    elapsed = time.perf_counter() - t0
+    return setup, counter[0], elapsed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    event_queue = HeapEventQueue
+    profile = False
+    while args and args[0].startswith('--'):
+        if args[0] == '--calendar':
+            event_queue = CalendarEventQueue
+        elif args[0] == '--profile':
+            profile = True
+        args = args[1:]
+    num_cars = int(args[0]) if args else NUM_CARS
+    sizes = [int(a) for a in args[1:]] or GRID_SIZES
+    print("{:>9} {:>10} {:>10} {:>10} {:>12}".format("grid", "setup(s)", "events", "loop(s)", "events/sec"))
+    for n in sizes:
+        profiler = EventLoopProfiler() if profile else None
+        setup, events, elapsed = run(n, num_cars, event_queue=event_queue, profiler=profiler)
+        print("{:>9} {:>10.2f} {:>10d} {:>10.2f} {:>12.0f}".format(
+            "{}x{}".format(n, n), setup, events, elapsed, events / elapsed))
+        if profiler is not None:
+            profiler.report()
@@ -0,0 +1,226 @@
+import mmap
+import struct
+from bisect import bisect_right
+from choreographer import Car, Choreographer
+from compact_grid import CompactGrid, KIND_NONE, KIND_INTERSECTION, KIND_INLET
+
+# Binary trace of the car movements of a run, written while simulating and replayed by
+# the Animator without running the simulation again.
+#
+# File layout (little endian):
+#   header      HEADER, patched when the writer is closed
+#   records     RECORD per car event, in event loop (time) order
+#   positions   count, then (x, y, kind) per IID
+#   checkpoints count, then per checkpoint (ts, records before it, n, n record indexes):
+#               the latest record of every car in the grid at that point
+#
+# A window of the run is replayed from the checkpoint before it, so only the records
+# of that stretch of time are ever read from the memory-mapped file.
+
+MAGIC = b'TRAFFIC1'
+HEADER = struct.Struct('<8sIQQ')  # magic, record size, record count, footer offset
+RECORD = struct.Struct('<dqi4b')  # ts, cid, iid, kind, incoming_d, outgoing_d, state
+POSITION = struct.Struct('<ddb')
+COUNT = struct.Struct('<Q')
+CHECKPOINT = struct.Struct('<dQQ')
+TS = struct.Struct('<d')
+
+REC_INTERSECTION = 0  # Choreographer.car_intersection_event
+REC_DEQUEUE = 1  # Choreographer.car_dequeue_event
+
+
+# Takes the place of the Choreographer of a TrafficGrid (same sample_rate) and writes
+# its events to path. Call close (or use it as a context manager) after the run.
+class TraceWriter(Choreographer):
+    def __init__(self, traffic_grid, path, sample_rate=1.0, checkpoint_interval=600,
+                 buffer_size=1 << 20):
+        super().__init__(traffic_grid, sample_rate)
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, RECORD.size, 0, 0))
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.n_records = 0
+        self.last_record = {}  # cid => index of its latest record, while in the grid
+        self.checkpoint_interval = checkpoint_interval
+        self.next_checkpoint = None
+        self.checkpoints = []  # (ts, record count, record indexes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, ts, cid, iid, kind, incoming_d, outgoing_d, state):
+        if self.next_checkpoint is None:
+            self.next_checkpoint = ts
+        if ts >= self.next_checkpoint:
+            self.checkpoints.append((ts, self.n_records, list(self.last_record.values())))
+            self.next_checkpoint = ts + self.checkpoint_interval
+        self.buffer += RECORD.pack(ts, cid, iid, kind, incoming_d, outgoing_d, state)
+        if outgoing_d == -1:
+            self.last_record.pop(cid, None)  # Left the grid
+        else:
+            self.last_record[cid] = self.n_records
+        self.n_records += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+    def car_intersection_event(self, ts, cid, iid, incoming_d, outgoing_d, state=0):
+        if self.is_sampled(cid):
+            self.write(ts, cid, iid, REC_INTERSECTION, incoming_d, outgoing_d, state)
+
+    def car_dequeue_event(self, ts, cid, iid, incoming_d, outgoing_d):
+        if self.is_sampled(cid):
+            self.write(ts, cid, iid, REC_DEQUEUE, incoming_d, outgoing_d, 0)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        footer = self.file.tell()
+        positions = self.positions()
+        self.file.write(COUNT.pack(len(positions)))
+        for x, y, kind in positions:
+            self.file.write(POSITION.pack(x, y, kind))
+        self.file.write(COUNT.pack(len(self.checkpoints)))
+        for ts, n_records, indexes in self.checkpoints:
+            self.file.write(CHECKPOINT.pack(ts, n_records, len(indexes)))
+            self.file.write(struct.pack('<%dQ' % len(indexes), *indexes))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, RECORD.size, self.n_records, footer))
+        self.file.close()
+        self.file = None
+
+    # (x, y, kind) of every IID of the grid
+    def positions(self):
+        ios = self.traffic_grid.intersections
+        if isinstance(ios, CompactGrid):
+            return [(ios.pos_x[iid], ios.pos_y[iid], ios.kind[iid]) for iid in range(len(ios))]
+        positions = []
+        for io in ios:
+            if io is None:
+                positions.append((0.0, 0.0, KIND_NONE))
+            else:
+                positions.append((io.pos_x, io.pos_y,
+                                  KIND_INLET if io.is_inlet() else KIND_INTERSECTION))
+        return positions
+
+
+# Intersection or inlet of a replayed grid, all the Animator and Choreographer need
+class TracePoint:
+    def __init__(self, iid, kind, pos_x, pos_y):
+        self.iid = iid
+        self.kind = kind
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+
+    def is_inlet(self):
+        return self.kind == KIND_INLET
+
+
+# Timestamps of the records, a sequence for bisect
+class RecordTimes:
+    def __init__(self, replay):
+        self.replay = replay
+
+    def __len__(self):
+        return self.replay.n_records
+
+    def __getitem__(self, i):
+        return TS.unpack_from(self.replay.data, HEADER.size + i * RECORD.size)[0]
+
+
+# Memory-mapped trace written by TraceWriter. Stands in for the TrafficGrid given to the
+# Animator: window_at(t) returns a Choreographer holding the cars around time t, built
+# from the file when t leaves the current window. Cars are replayed up to lookahead
+# seconds past the window, which should be longer than the travel time between
+# intersections so that cars on the road know where they are going. Replay starts from a
+# checkpoint at least lookback seconds before the window, longer than the trajectory of
+# a record lasts after it (e.g. a car leaving the grid is shown for 10 more seconds).
+class TraceReplay:
+    def __init__(self, path, window_length=60, lookahead=60, lookback=30):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, record_size, self.n_records, footer = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError("{} is not a traffic trace".format(path))
+        self.window_length = window_length
+        self.lookahead = lookahead
+        self.lookback = lookback
+        self.times = RecordTimes(self)
+
+        offset = footer
+        n = COUNT.unpack_from(self.data, offset)[0]
+        offset += COUNT.size
+        self.intersections = []
+        for iid in range(n):
+            x, y, kind = POSITION.unpack_from(self.data, offset)
+            offset += POSITION.size
+            self.intersections.append(TracePoint(iid, kind, x, y) if kind != KIND_NONE else None)
+        n = COUNT.unpack_from(self.data, offset)[0]
+        offset += COUNT.size
+        self.checkpoint_ts = []
+        self.checkpoints = []  # (records before it, count, offset of its indexes)
+        for i in range(n):
+            ts, n_records, count = CHECKPOINT.unpack_from(self.data, offset)
+            offset += CHECKPOINT.size
+            self.checkpoint_ts.append(ts)
+            self.checkpoints.append((n_records, count, offset))
+            offset += 8 * count
+
+        self.window = None  # (t0, t1) of the current choreographer
+        self.choreographer = None
+
+    def close(self):
+        self.choreographer = None
+        self.data.close()
+        self.file.close()
+
+    def start_time(self):
+        return self.times[0] if self.n_records else 0
+
+    def end_time(self):
+        return self.times[self.n_records - 1] if self.n_records else 0
+
+    def record(self, i):
+        return RECORD.unpack_from(self.data, HEADER.size + i * RECORD.size)
+
+    # Windows are aligned on start_time() + k * window_length, so what is replayed for t
+    # only depends on t and not on the times asked for before
+    def window_at(self, t):
+        if self.window is None or not self.window[0] <= t < self.window[1]:
+            start = self.start_time()
+            t0 = start + ((t - start) // self.window_length) * self.window_length
+            self.choreographer = self.load(t0, t0 + self.window_length)
+            self.window = (t0, t0 + self.window_length)
+        return self.choreographer
+
+    # Choreographer of the cars in the grid between t0 and t1
+    def load(self, t0, t1):
+        c = bisect_right(self.checkpoint_ts, t0 - self.lookback) - 1
+        if c >= 0:
+            first, count, offset = self.checkpoints[c]
+            indexes = sorted(struct.unpack_from('<%dQ' % count, self.data, offset))
+        else:
+            first = 0
+            indexes = []
+        end = bisect_right(self.times, t1 + self.lookahead)
+        choreographer = Choreographer(self)
+        for i in indexes + list(range(first, end)):
+            ts, cid, iid, kind, incoming_d, outgoing_d, state = self.record(i)
+            if kind == REC_DEQUEUE:
+                # Live, the car is still at the intersection of its previous record, which
+                # may be before the checkpoint
+                car = choreographer.cars.get(cid)
+                if car is None:
+                    car = choreographer.cars[cid] = Car(cid)
+                car.set_current_intersection(self.intersections[iid])
+                choreographer.car_dequeue_event(ts, cid, iid, incoming_d, outgoing_d)
+            else:
+                choreographer.car_intersection_event(ts, cid, iid, incoming_d, outgoing_d, state)
+        return choreographer
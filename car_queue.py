@@ -0,0 +1,63 @@
+from array import array
+
+
+# FIFO of the cars stopped in one outgoing queue of an intersection.
+# The (ts, cid, from, to) fields live in parallel typed arrays used as a ring
+# buffer, so append and popleft are O(1) and no per-car list is allocated.
+class CarQueue:
+    __slots__ = ('ts', 'cid', 'from_d', 'to_d', 'head', 'size', 'mask')
+
+    def __init__(self):
+        # Columns are only allocated when the first car stops here
+        self.ts = None
+        self.cid = None
+        self.from_d = None
+        self.to_d = None
+        self.head = 0
+        self.size = 0
+        self.mask = -1  # capacity - 1, capacity is always a power of 2
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ts, cid, from_d, to_d):
+        if self.size > self.mask:
+            self.grow()
+        i = (self.head + self.size) & self.mask
+        self.ts[i] = ts
+        self.cid[i] = cid
+        self.from_d[i] = from_d
+        self.to_d[i] = to_d
+        self.size += 1
+
+    def popleft(self):
+        if not self.size:
+            raise IndexError("pop from an empty CarQueue")
+        i = self.head
+        item = (self.ts[i], self.cid[i], self.from_d[i], self.to_d[i])
+        self.head = (i + 1) & self.mask
+        self.size -= 1
+        return item
+
+    def peek_cid(self):
+        if not self.size:
+            raise IndexError("peek into an empty CarQueue")
+        return self.cid[self.head]
+
+    def grow(self):
+        capacity = (self.mask + 1) * 2 if self.mask >= 0 else 4
+        h = self.head
+        if self.ts is None:
+            self.ts = array('d', [0.0]) * capacity
+            self.cid = array('q', [0]) * capacity
+            self.from_d = array('b', [0]) * capacity
+            self.to_d = array('b', [0]) * capacity
+        else:
+            # The ring is full here, unroll it so the oldest car sits at index 0
+            n = capacity - self.size
+            self.ts = self.ts[h:] + self.ts[:h] + array('d', [0.0]) * n
+            self.cid = self.cid[h:] + self.cid[:h] + array('q', [0]) * n
+            self.from_d = self.from_d[h:] + self.from_d[:h] + array('b', [0]) * n
+            self.to_d = self.to_d[h:] + self.to_d[:h] + array('b', [0]) * n
+        self.head = 0
+        self.mask = capacity - 1
@@ -1,13 +1,28 @@
-from heapq import *
+from array import array
+from bisect import bisect_left, bisect_right
 from constants import *
 
+NAN = float('nan')
 
+
+# Trajectory of a car: points (t, x, y, dir, iid of the intersection it is placed
+# around) sorted by t in parallel typed arrays, a point without position (NaN) means
+# the car is gone. Lookups bisect the times, and start from the previous lookup
+# (cursor) so that playing forward is O(1) per frame.
 class Car:
     def __init__(self, cid):
         self.id = cid
-        self.time_line = []
+        self.t = array('d')
+        self.x = array('d')
+        self.y = array('d')
+        self.dir = array('b')
+        self.iid = array('i')
+        self.cursor = 0  # Segment found by the last info call
         self.io = None
 
+    def __len__(self):
+        return len(self.t)
+
     def set_current_intersection(self, io):
         self.io = io
 
@@ -15,8 +30,21 @@ class Car:
         if xy is not None:
             x = xy[0] + self.io.pos_x
             y = xy[1] + self.io.pos_y
-            xy = (x, y)
-        heappush(self.time_line, [ts, xy, d])
+        else:
+            x = y = NAN
+        if not self.t or ts >= self.t[-1]:
+            self.t.append(ts)
+            self.x.append(x)
+            self.y.append(y)
+            self.dir.append(d)
+            self.iid.append(self.io.iid)
+        else:
+            i = bisect_right(self.t, ts)
+            self.t.insert(i, ts)
+            self.x.insert(i, x)
+            self.y.insert(i, y)
+            self.dir.insert(i, d)
+            self.iid.insert(i, self.io.iid)
 
     def add_tl_enter(self, ts, d):
         x0 = ISEC_SIZE + ZEBRA_WIDTH + QZONE_LEN + SZONE_LEN
@@ -59,57 +87,74 @@ class Car:
         self.add_time_line_item(ts, DIR_POS(id, 0.75 * LANE_WIDTH, 0), id)
         self.add_time_line_item(ts + 0.1, None, -1)
 
-    def info(self, ts):  # returns (xy, angle) at given ts
-        ntl = len(self.time_line)
-        if ts < self.time_line[0][0]:
-            it = self.time_line[0]
-            if it[1] is None:
-                return None
-            return (it[1][0], it[1][1], it[2])
-        elif ts >= self.time_line[ntl-1][0]:
-            it = self.time_line[ntl-1]
-            if it[1] is None:
-                return None
-            return (it[1][0], it[1][1], it[2])
-
-        i = 0
-        while i < ntl -1 and ts > self.time_line[i+1][0]:
-            i += 1
-
-        if self.time_line[i][1] is None:
+    def point(self, i):
+        x = self.x[i]
+        if x != x:  # NaN, the car is gone
             return None
+        return (x, self.y[i], self.dir[i])
 
-        x0, y0 = self.time_line[i][1]
-        d0 = self.time_line[i][2] * 90
-
-        if self.time_line[i+1][1] is None:
-            it = self.time_line[i]
-            return (it[1][0], it[1][1], it[2])
+    def info(self, ts):  # returns (xy, angle) at given ts
+        t = self.t
+        ntl = len(t)
+        if ts < t[0]:
+            return self.point(0)
+        elif ts >= t[ntl - 1]:
+            return self.point(ntl - 1)
+
+        # Segment i with t[i] < ts <= t[i + 1] (i = 0 when ts == t[0])
+        i = self.cursor
+        if i + 1 >= ntl or not t[i] < ts <= t[i + 1]:
+            if i + 2 < ntl and t[i + 1] < ts <= t[i + 2]:
+                i += 1
+            else:
+                i = max(bisect_left(t, ts) - 1, 0)
+            self.cursor = i
+
+        x0 = self.x[i]
+        if x0 != x0:
+            return None
+        y0 = self.y[i]
+        d0 = self.dir[i] * 90
 
-        x1, y1 = self.time_line[i+1][1]
-        d1 = self.time_line[i+1][2] * 90
+        x1 = self.x[i + 1]
+        if x1 != x1:
+            return (x0, y0, self.dir[i])
+        y1 = self.y[i + 1]
+        d1 = self.dir[i + 1] * 90
 
         if d0 - d1 > 180:
             d1 += 360
         elif d0 - d1 < -190:
             d0 += 360
 
-        dt = self.time_line[i+1][0] - self.time_line[i][0]
-        a1 = (ts - self.time_line[i][0]) / dt
-        a0 = 1 - a1  # (self.time_line[i+1][0] - ts) / dt
+        dt = t[i + 1] - t[i]
+        a1 = (ts - t[i]) / dt
+        a0 = 1 - a1  # (t[i + 1] - ts) / dt
 
         return (a0 * x0 + a1 * x1, a0 * y0 + a1 * y1, a0 * d0 + a1 * d1)
 
+# Builds the trajectory of every car for the Animator. With a sample_rate below 1 only
+# that (deterministic, by car id) fraction of the cars is kept, the other cars are
+# ignored, so long runs don't keep a timeline per car.
 class Choreographer:
-    def __init__(self, traffic_grid):
+    def __init__(self, traffic_grid, sample_rate=1.0):
         self.traffic_grid = traffic_grid
         self.cars = {}
+        self.sample_rate = sample_rate
+
+    def is_sampled(self, cid):
+        if self.sample_rate >= 1:
+            return True
+        # Multiplicative hash spreads consecutive car ids over [0, 1)
+        return (cid * 2654435761 & 0xFFFFFFFF) < self.sample_rate * 0x100000000
 
     def car_info(self, cid, ts):
         car = self.cars[cid]
         return car.info(ts)
 
     def car_intersection_event(self, ts, cid, iid, incoming_d, outgoing_d, state=0):
+        if not self.is_sampled(cid):
+            return
         if not cid in self.cars:
             self.cars[cid] = Car(cid)
         car = self.cars[cid]
@@ -137,6 +182,8 @@ class Choreographer:
             car.add_tl_to_qpos(ts, incoming_d, lane, state)
 
     def car_dequeue_event(self, ts, cid, iid, incoming_d, outgoing_d):
+        if not self.is_sampled(cid):
+            return
         if not cid in self.cars:
             self.cars[cid] = Car(cid)
         car = self.cars[cid]
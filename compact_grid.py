@@ -0,0 +1,84 @@
+from array import array
+from traffic_grid import Intersection, Inlet, grid_layout, grid_neighbours
+
+KIND_NONE = 0  # Corners of the grid
+KIND_INTERSECTION = 1
+KIND_INLET = 2
+
+
+# Grid storage for very large generated networks. Topology and positions are kept in
+# flat typed arrays indexed by IID, Intersection objects are only created the first
+# time a cell is accessed (i.e. when the first car gets there). Can be used wherever
+# TrafficGrid.intersections is indexed by IID.
+#
+# A materialized intersection starts its light cycle when it is created (in the phase
+# it would have on a full grid), so the lights of intersections no car ever reaches
+# cost nothing. Only those are saved: a materialized intersection keeps its light and
+# queues in its Intersection object and is never released, so a run reaching every
+# intersection takes as much memory as a full grid.
+class CompactGrid:
+    def __init__(self, grid, m, n):
+        self.grid = grid
+        self.m = m
+        self.n = n
+        size = (m + 2) * (n + 2)
+        self.size = size
+        self.kind = array('b', bytes(size))
+        self.from_iids = array('i', [-1]) * (4 * size)  # 4 entries per IID
+        self.to_iids = array('i', [-1]) * (4 * size)
+        self.pos_x = array('d', [0.0]) * size
+        self.pos_y = array('d', [0.0]) * size
+        self.materialized = {}  # iid => Intersection or Inlet
+        self.inlets = []
+
+        for iid, pos_x, pos_y, to_iid, d in grid_layout(m, n):
+            self.pos_x[iid] = pos_x
+            self.pos_y[iid] = pos_y
+            if to_iid is None:
+                self.kind[iid] = KIND_INTERSECTION
+                for d, nb_iid in enumerate(grid_neighbours(iid, m)):
+                    self.from_iids[4 * iid + d] = nb_iid
+                    self.to_iids[4 * iid + d] = nb_iid
+            else:
+                # Inlets only line the edges, they are cheap to keep as objects
+                self.kind[iid] = KIND_INLET
+                self.to_iids[4 * iid] = to_iid
+                io = Inlet(iid, to_iid, d)
+                io.set_position(pos_x, pos_y)
+                self.materialized[iid] = io
+                self.inlets.append(io)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, iid):
+        io = self.materialized.get(iid)
+        if io is None and self.kind[iid] == KIND_INTERSECTION:
+            io = self.materialize(iid)
+        return io
+
+    # Like iterating over a list of intersections, but creates every Intersection
+    def __iter__(self):
+        for iid in range(self.size):
+            yield self[iid]
+
+    def is_materialized(self, iid):
+        return iid in self.materialized
+
+    def materialize(self, iid):
+        grid = self.grid
+        io = Intersection(iid, grid)
+        io.set_position(self.pos_x[iid], self.pos_y[iid])
+        for d in range(io.n_from):
+            io.assign_from_iid(d, self.from_iids[4 * iid + d])
+            io.assign_to_iid(d, self.to_iids[4 * iid + d])
+        self.materialized[iid] = io
+        return io
+
+
+# Compact counterpart of TrafficGrid.generate_grid
+def generate_compact_grid(grid, m, n):
+    compact = CompactGrid(grid, m, n)
+    grid.intersections = compact
+    grid.inlets = compact.inlets
+    return compact
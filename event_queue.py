@@ -0,0 +1,111 @@
+import heapq
+from collections import namedtuple
+from functools import partial
+
+# Event queues for TrafficGrid. Every queue pops events in (ts, type, seq) order: at
+# the same time events are handled by type (see EV_* in traffic_grid), and events of
+# the same type in the order they were pushed. seq is unique, so comparisons never
+# reach the payload.
+
+# Event record, a tuple subclass without a per-instance __dict__
+Event = namedtuple('Event', ['ts', 'type', 'seq', 'payload'])
+
+
+# Plain binary heap, works for any timestamp (including fractional ones)
+class HeapEventQueue:
+    def __init__(self):
+        self.heap = []
+        # Bound straight to heapq so the event loop doesn't pay for an extra call
+        self.push = partial(heapq.heappush, self.heap)
+        self.pop = partial(heapq.heappop, self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Next event without removing it, None when empty
+    def peek(self):
+        return self.heap[0] if self.heap else None
+
+
+# Calendar (bucket) queue for integer timestamps: a ring with one bucket per tick
+# covering [now, now + n_buckets). Events scheduled further ahead wait in an
+# overflow heap and are moved into the ring once the window reaches them.
+# n_buckets should be larger than the usual scheduling delay (travel time, light
+# phase), otherwise most pushes end up in the overflow heap.
+class CalendarEventQueue:
+    def __init__(self, n_buckets=256):
+        size = 1
+        while size < n_buckets:
+            size <<= 1
+        self.n_buckets = size
+        self.mask = size - 1
+        self.buckets = [[] for i in range(size)]
+        self.now = None  # Lowest timestamp covered by the ring
+        self.in_ring = 0
+        self.overflow = []
+
+    def __len__(self):
+        return self.in_ring + len(self.overflow)
+
+    def peek(self):
+        if self.in_ring:
+            for t in range(self.now, self.now + self.n_buckets):
+                bucket = self.buckets[t & self.mask]
+                if bucket:
+                    return bucket[0]
+        return self.overflow[0] if self.overflow else None
+
+    def push(self, ev):
+        ts = ev[0]
+        if type(ts) is not int:
+            raise TypeError("CalendarEventQueue needs integer timestamps, got {!r} "
+                            "(use HeapEventQueue instead)".format(ts))
+        if self.now is None:
+            self.now = ts
+        elif ts < self.now:
+            self.rewind(ts)
+        if ts - self.now < self.n_buckets:
+            # All events in a bucket share the same ts, a small heap orders them
+            heapq.heappush(self.buckets[ts & self.mask], ev)
+            self.in_ring += 1
+        else:
+            heapq.heappush(self.overflow, ev)
+
+    def pop(self):
+        buckets = self.buckets
+        mask = self.mask
+        while True:
+            bucket = buckets[self.now & mask]
+            if bucket:
+                self.in_ring -= 1
+                return heapq.heappop(bucket)
+            if self.in_ring:
+                self.now += 1
+            elif self.overflow:
+                self.now = self.overflow[0][0]  # Jump over the empty stretch
+            else:
+                raise IndexError("pop from an empty event queue")
+            self.refill()
+
+    def refill(self):
+        overflow = self.overflow
+        limit = self.now + self.n_buckets
+        while overflow and overflow[0][0] < limit:
+            ev = heapq.heappop(overflow)
+            heapq.heappush(self.buckets[ev[0] & self.mask], ev)
+            self.in_ring += 1
+
+    # Moves the window back to start at ts, events falling off its end go to overflow.
+    # Only happens for events scheduled before the current time (e.g. negative light
+    # offsets pushed while the grid is being built).
+    def rewind(self, ts):
+        n = self.n_buckets
+        if self.in_ring:
+            for t in range(max(ts + n, self.now), self.now + n):
+                bucket = self.buckets[t & self.mask]
+                if bucket:
+                    self.in_ring -= len(bucket)
+                    for ev in bucket:
+                        heapq.heappush(self.overflow, ev)
+                    bucket.clear()
+        self.now = ts
@@ -0,0 +1,121 @@
+import os, sys
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # No display needed, set before pygame starts
+
+import pygame
+from animator import Animator
+from binary_trace import TraceReplay
+
+# Renders the frames of a trace written by TraceWriter without a window, one frame
+# every step simulated seconds from start to end (the whole trace by default), instead
+# of the Animator's live playback at wall clock speed.
+#
+# Frames are written as out/frame_000000.png ... or, with raw, as one file of RGB24
+# frames (width * height * 3 bytes each, in order), e.g. for
+#   ffmpeg -f rawvideo -pix_fmt rgb24 -s 900x900 -r 30 -i out.rgb out.mp4
+#
+# With workers > 1 the frames are cut into contiguous ranges rendered by a process
+# pool, each worker replaying the trace memory-mapped on its own. Consecutive frames of
+# a range mostly share the replay window and the car trajectories packed for it. A
+# frame only depends on its time (replay windows are aligned, car looks come from the
+# cid), so the output is the same for any number of workers and FRAMES_PER_TASK.
+
+FRAMES_PER_TASK = 120
+
+
+class FrameExporter:
+    def __init__(self, trace_path, out, step=1.0, start=None, end=None, screen_size=(900, 900),
+                 screen_scale=None, screen_offset=(0, 0), raw=False, workers=1):
+        self.trace_path = trace_path
+        self.out = out
+        self.step = step
+        self.screen_size = screen_size
+        self.screen_scale = screen_scale  # Default of the Animator when None
+        self.screen_offset = screen_offset
+        self.raw = raw
+        self.workers = workers
+        replay = TraceReplay(trace_path)
+        self.start = start if start is not None else replay.start_time()
+        self.end = end if end is not None else replay.end_time()
+        replay.close()
+
+    def frame_count(self):
+        if self.end < self.start:
+            return 0
+        return int((self.end - self.start) / self.step) + 1
+
+    def frame_time(self, k):
+        return self.start + k * self.step
+
+    def frame_path(self, k):
+        return os.path.join(self.out, 'frame_{:06d}.png'.format(k))
+
+    def frame_size(self):
+        return self.screen_size[0] * self.screen_size[1] * 3
+
+    # Renders every frame, returns how many
+    def run(self):
+        n = self.frame_count()
+        if self.raw:
+            with open(self.out, 'wb') as f:
+                f.truncate(n * self.frame_size())  # Workers write their frames in place
+        else:
+            os.makedirs(self.out, exist_ok=True)
+        tasks = [(k, min(k + FRAMES_PER_TASK, n)) for k in range(0, n, FRAMES_PER_TASK)]
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(export_frames, [self] * len(tasks), *zip(*tasks)))
+        else:
+            for first, end in tasks:
+                export_frames(self, first, end)
+        return n
+
+
+animators = {}  # Per process, trace path => Animator replaying it
+
+
+def export_frames(exporter, first, end):
+    animator = animators.get(exporter.trace_path)
+    if animator is None or animator.screen_size != exporter.screen_size:
+        animator = Animator(TraceReplay(exporter.trace_path), exporter.screen_size)
+        animators[exporter.trace_path] = animator
+    if exporter.screen_scale is not None:
+        animator.screen_scale = exporter.screen_scale
+    animator.screen_offset = exporter.screen_offset
+    raw = open(exporter.out, 'r+b') if exporter.raw else None
+    try:
+        if raw is not None:
+            raw.seek(first * exporter.frame_size())
+        for k in range(first, end):
+            animator.draw(exporter.frame_time(k))
+            if raw is not None:
+                raw.write(pygame.image.tobytes(animator.disp, 'RGB'))
+            else:
+                pygame.image.save(animator.disp, exporter.frame_path(k))
+    finally:
+        if raw is not None:
+            raw.close()
+
+
+if __name__ == "__main__":
+    # python frame_export.py [--raw] [--workers N] [--step S] trace.bin out [start end]
+    args = sys.argv[1:]
+    options = {}
+    while args and args[0].startswith('--'):
+        if args[0] == '--raw':
+            options['raw'] = True
+            args = args[1:]
+        elif args[0] == '--workers':
+            options['workers'] = int(args[1])
+            args = args[2:]
+        elif args[0] == '--step':
+            options['step'] = float(args[1])
+            args = args[2:]
+        else:
+            sys.exit("unknown option " + args[0])
+    if len(args) > 2:
+        options['start'] = float(args[2])
+        options['end'] = float(args[3])
+    exporter = FrameExporter(args[0], args[1], **options)
+    print("Exported", exporter.run(), "frames to", exporter.out)
@@ -1,4 +1,4 @@
-import random
+from random_streams import RNG_LIGHT
 
 EV_ALL_STOP = -1
 EV_CAR_STOPPED = 1
@@ -6,53 +6,61 @@ EV_CAR_ENTER_INTERSECTION = 2
 EV_LIGHT_CHANGE = 3
 EV_DEQUEUE_GREEN = 4  # This is the slow de-queuing of a light just turned green
 
+# Light cycle: red/green for every qid % 8, then the duration of the phase.
+# Assuming that any light configuration will be rotationally symmetrical,
+# Can be altered to be asymmetrical (per light, every light gets its own copy)
+# 1 is red, 0 is green
+CYCLE_PHASES = (
+    (1, 1, 1, 1, 0, 0, 0, 0, 50),
+    (1, 1, 1, 1, 1, 1, 1, 1, 4),
+    (0, 0, 0, 0, 1, 1, 1, 1, 50),
+)
+
 
 # This is the "basic light", which has a pair of connected red/green lights
 class LightState:
     def __init__(self, Intersection):
         super()
         # period and start determines how lights change
-        self.phases = [
-            # Assuming that any light configuration will be rotationally symmetrical,
-            # Can be altered to be asymmetrical
-            #
-            [1, 1, 1, 1, 0, 0, 0, 0, 50],
-            [1, 1, 1, 1, 1, 1, 1, 1, 4],
-            [0, 0, 0, 0, 1, 1, 1, 1, 50]
-        ]
+        self.phases = [list(phase) for phase in CYCLE_PHASES]
         self.period = 100  # Typical red light duration
         self.half_period = 50
         self.start = 0
         # 0 = E-W, 1 = N-S
         self.state = 0
         self.itn = Intersection
-        self.itn.grid.add_event(EV_LIGHT_CHANGE, self.start + self.phases[self.state][8],
-                                True, (1, self.itn.iid))
+        self.start_cycle()
 
     def is_red_at_time(self, time, d, qid):
         return self.phases[self.state][qid % 8]
 
+    # The cycle runs as if it had started at time start, whenever the light is created
+    # (e.g. by a CompactGrid when the first car gets there): begins in the phase in
+    # effect at creation, with its change at creation or later, never in the past of the
+    # event loop. Lights created late are in the same phase as those of a full grid.
+    def start_cycle(self):
+        grid = self.itn.grid
+        now = grid.last_event_ts
+        ts = self.start + self.phases[self.state][8]
+        while ts < now:
+            self.state = (self.state + 1) % len(self.phases)
+            ts += self.phases[self.state][8]
+        grid.add_event(EV_LIGHT_CHANGE, ts, True,
+                       ((self.state + 1) % len(self.phases), self.itn.iid))
+
 
 class LightState1(LightState):
     def __init__(self, Intersection):
         super()
         # period and start determines how lights change
-        self.phases = [
-            # Assuming that any light configuration will be rotationally symmetrical,
-            # Can be altered to be asymmetrical
-            # 1 is red, 0 is green
-            [1, 1, 1, 1, 0, 0, 0, 0, 50],
-            [1, 1, 1, 1, 1, 1, 1, 1, 4],
-            [0, 0, 0, 0, 1, 1, 1, 1, 50]
-        ]
+        self.phases = [list(phase) for phase in CYCLE_PHASES]
         self.period = 100  # Typical red light duration
         self.half_period = 50
-        self.start = random.randint(-100, 0)
+        self.start = Intersection.grid.rng.randint(RNG_LIGHT, Intersection.iid, -100, 0)
         # 0 = E-W, 1 = N-S
         self.state = 0
         self.itn = Intersection
-        self.itn.grid.add_event(EV_LIGHT_CHANGE, self.start + self.phases[self.state][8],
-                                True, (1, self.itn.iid))
+        self.start_cycle()
 
     def is_red_at_time(self, time, d, qid):
         return self.phases[self.state][qid % 8]
@@ -61,16 +69,10 @@ class LightState1(LightState):
 # Smarter cycle light that resets the cycle whenever a queue reaches over x cars
 class LightState2(LightState1):
     def is_red_at_time(self, time, d, qid):
-        # 8 is the number of routes not with rotate. symm. ones (n_from * n_to / 2)
-        test = (self.itn.iid == 16)
         end_state = self.state
-        # sum is the number of cars in that direction
-        sum = 1
-        s_block = (int)(qid / 4) * 4
-        for i in range(s_block, s_block + 4):
-            sum += len(self.itn.outgoing_queue[i % 16])
-        for i in range(s_block + 8, s_block + 12):
-            sum += len(self.itn.outgoing_queue[i % 16])
+        # sum is the number of cars in that direction: the queues coming from d and
+        # from the opposite direction, i.e. the axis of d
+        sum = 1 + self.itn.axis_queue_len[d & 1]
         if sum >= 2:
             # self.itn.grid.add_event(EV_ALL_STOP, time, True, None)
             for i in range(len(self.phases)):
@@ -0,0 +1,310 @@
+from bisect import bisect_right
+from multiprocessing import Pipe, Process
+from random_streams import KeyedRandom
+from running_stats import RunningStats
+from traffic_grid import TrafficGrid, Statistics, EV_CAR_ENTER_INTERSECTION
+
+# Parallel discrete event simulation of one run: the grid is cut into rectangles of
+# intersections, each simulated by its own TrafficGrid (in its own process) with its own
+# event queue. A car driving into another partition is sent to it as a message,
+# together with its random draw counters and entry time.
+#
+# Synchronization is conservative: no car reaches another intersection sooner than the
+# shortest travel time L of the meshes, so when every pending event is at T or later
+# all partitions can handle the events before T + L on their own. Messages sent meanwhile
+# arrive at T + L or later and are delivered before the next window.
+#
+# Results are exactly those of the sequential loop with the same KeyedRandom seed and
+# canonical_order (Statistics.canonical_order = True and common_random_numbers = True):
+# events are ordered by (ts, type, canonical seq) in both, which only depends on the
+# events. The run stops at the num_cars-th car leaving the grid in that order, so in
+# the last window every partition reports where its statistics stood at that event.
+#
+# Not supported: routes where cars go home (p_stop > 0, that stops the whole run) and
+# choreographers.
+
+
+# The TrafficGrid of one partition, intersections outside of it are None
+class PartitionGrid(TrafficGrid):
+    def __init__(self, event_queue, rng, light_state_class):
+        super().__init__(float('inf'), False, event_queue=event_queue, rng=rng,
+                         light_state_class=light_state_class, canonical_order=True)
+        self.outbox = []  # (ts, payload, draw counters, entry ts) of cars leaving the partition
+        self.window_log = []  # (ts, type, seq, total_wait_time, count_waited) of this window
+        self.window_start = (0, 0)  # (total_wait_time, count_waited) when the window started
+        self.last_trip = None
+
+    def add_event(self, ev_type, ts, valid, payload):
+        if ev_type == EV_CAR_ENTER_INTERSECTION and self.intersections[payload[1]] is None:
+            cid = payload[0]
+            self.outbox.append((ts, payload, self.rng.draws.pop(cid, None),
+                                self.car_entry_ts.pop(cid, None)))
+            return
+        super().add_event(ev_type, ts, valid, payload)
+
+    def receive(self, ts, payload, draws, entry_ts):
+        cid = payload[0]
+        if draws is not None:
+            self.rng.draws[cid] = draws
+        if entry_ts is not None:
+            self.car_entry_ts[cid] = entry_ts
+        super().add_event(EV_CAR_ENTER_INTERSECTION, ts, True, payload)
+
+    def finalize_car(self, ts, cid):
+        entry_ts = self.car_entry_ts.get(cid)
+        self.last_trip = ts - entry_ts if entry_ts is not None else None
+        super().finalize_car(ts, cid)
+
+    # run_events for the events before until. Returns the cars that left the grid as
+    # (ts, type, seq, trip time) and logs every change of the wait statistics.
+    def run_window(self, until):
+        self.window_start = (self.total_wait_time, self.count_waited)
+        log = self.window_log = []
+        exits = []
+        count = self.count_waited
+
+        def on_event(ts, ev_type, seq, done):
+            nonlocal count
+            if done:
+                exits.append((ts, ev_type, seq, self.last_trip))
+            elif self.count_waited != count:
+                log.append((ts, ev_type, seq, self.total_wait_time, self.count_waited))
+            count = self.count_waited
+
+        self.run_events(until=until, on_event=on_event)
+        return exits
+
+    # (total_wait_time, count_waited) right after the event key = (ts, type, seq) of
+    # the current window
+    def stats_at(self, key):
+        i = bisect_right([entry[:3] for entry in self.window_log], key)
+        if i == 0:
+            return self.window_start
+        return self.window_log[i - 1][3:]
+
+
+# Only the arrivals entering the grid at intersections of the partition
+class LocalArrivals:
+    def __init__(self, source, grid):
+        self.source = source
+        self.grid = grid
+
+    def __iter__(self):
+        for arrival in self.source:
+            if self.grid.intersections[arrival[2]] is not None:
+                yield arrival
+            else:
+                self.grid.rng.forget(arrival[1])  # Drawn again by its own partition
+
+
+# Intersections with i_lo <= i < i_hi and j_lo <= j < j_hi in grid_layout coordinates
+class Rectangle:
+    def __init__(self, m, i_lo, i_hi, j_lo, j_hi):
+        self.m = m
+        self.i_lo = i_lo
+        self.i_hi = i_hi
+        self.j_lo = j_lo
+        self.j_hi = j_hi
+
+    def __call__(self, iid):
+        i = iid % (self.m + 2)
+        j = iid // (self.m + 2)
+        return self.i_lo <= i < self.i_hi and self.j_lo <= j < self.j_hi
+
+
+# Cuts the grid_size x grid_size grid into px x py rectangles
+def grid_partitions(grid_size, px, py):
+    cuts_i = [1 + grid_size * k // px for k in range(px + 1)]
+    cuts_j = [1 + grid_size * k // py for k in range(py + 1)]
+    return [Rectangle(grid_size, cuts_i[a], cuts_i[a + 1], cuts_j[b], cuts_j[b + 1])
+            for b in range(py) for a in range(px)]
+
+
+# One partition of a run of stats with the given seed
+class Partition:
+    def __init__(self, stats, seed, owns):
+        grid = self.grid = PartitionGrid(stats.event_queue(), KeyedRandom(seed),
+                                         stats.light_state_class)
+        grid.generate_grid(stats.grid_size, stats.grid_size, owns)
+        grid.add_arrivals(LocalArrivals(stats.arrivals(grid), grid))
+
+    # Shortest travel time of the partition (None without intersections) and next event
+    def start(self):
+        routes = [route for io in self.grid.intersections
+                  if io is not None and not io.is_inlet() for route in io.mesh]
+        if any(route.p_stop > 0 for route in routes):
+            raise ValueError("partitioned runs do not support routes with p_stop > 0")
+        lookahead = min((route.travel_time for route in routes), default=None)
+        return lookahead, self.next_ts()
+
+    def next_ts(self):
+        ev = self.grid.events.peek()
+        return ev[0] if ev is not None else None
+
+    # Delivers the messages and runs the window, returns the messages sent, the cars
+    # that left and the time of the next event
+    def window(self, until, messages):
+        grid = self.grid
+        for message in messages:
+            grid.receive(*message)
+        exits = grid.run_window(until)
+        outbox = grid.outbox
+        grid.outbox = []
+        return outbox, exits, self.next_ts()
+
+    def stats_at(self, key):
+        return self.grid.stats_at(key)
+
+
+# Partition run in the calling process
+class InlinePartition:
+    def __init__(self, *args):
+        self.partition = Partition(*args)
+        self.reply = None
+
+    def call(self, name, *args):
+        self.reply = getattr(self.partition, name)(*args)
+
+    def result(self):
+        return self.reply
+
+    def close(self):
+        pass
+
+
+# Partition run in its own process, calls return without waiting for the result
+class PartitionProcess:
+    def __init__(self, *args):
+        self.conn, child = Pipe()
+        self.process = Process(target=partition_worker, args=(child,) + args, daemon=True)
+        self.process.start()
+
+    def call(self, name, *args):
+        self.conn.send((name, args))
+
+    def result(self):
+        reply = self.conn.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join()
+
+
+def partition_worker(conn, *args):
+    try:
+        partition = Partition(*args)
+    except Exception as e:
+        partition = e
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        if isinstance(partition, Exception):
+            conn.send(partition)
+            continue
+        name, call_args = command
+        try:
+            conn.send(getattr(partition, name)(*call_args))
+        except Exception as e:
+            conn.send(e)
+
+
+# One run of the stats parameters with the given seed on px x py partitions. processes
+# False runs every partition in this process (same results, for testing).
+class PartitionedRun:
+    def __init__(self, stats, seed, partitions=(2, 2), processes=True):
+        self.stats = stats
+        self.seed = seed
+        self.partitions = partitions
+        self.processes = processes
+        self.total_wait_time = 0
+        self.count_waited = 0
+        self.trip_times = RunningStats()
+        self.cars_exited = 0
+        self.windows = 0
+        self.messages = 0
+
+    def run(self):
+        stats = self.stats
+        owners = grid_partitions(stats.grid_size, *self.partitions)
+        kind = PartitionProcess if self.processes else InlinePartition
+        parts = [kind(stats, self.seed, owns) for owns in owners]
+        try:
+            self.simulate(parts, owners)
+        finally:
+            for part in parts:
+                part.close()
+        return self.total_wait_time / self.count_waited
+
+    def simulate(self, parts, owners):
+        num_cars = self.stats.num_cars
+        for part in parts:
+            part.call('start')
+        lookaheads = []
+        next_ts = []
+        for part in parts:
+            lookahead, ts = part.result()
+            if lookahead is not None:
+                lookaheads.append(lookahead)
+            next_ts.append(ts)
+        lookahead = min(lookaheads)
+        inboxes = [[] for part in parts]
+        cut = None
+        while cut is None:
+            pending = [ts for ts in next_ts if ts is not None]
+            pending += [message[0] for inbox in inboxes for message in inbox]
+            if not pending:
+                raise IndexError("no events left before num_cars cars left the grid")
+            until = min(pending) + lookahead
+            for part, inbox in zip(parts, inboxes):
+                part.call('window', until, inbox)
+            inboxes = [[] for part in parts]
+            exits = []
+            for p, part in enumerate(parts):
+                outbox, part_exits, next_ts[p] = part.result()
+                exits += part_exits
+                for message in outbox:
+                    to_iid = message[1][1]
+                    for q, owns in enumerate(owners):
+                        if owns(to_iid):
+                            inboxes[q].append(message)
+                            break
+                self.messages += len(outbox)
+            self.windows += 1
+            # In the order of the sequential loop, which stops at the num_cars-th
+            for ts, ev_type, seq, trip in sorted(exits):
+                self.cars_exited += 1
+                if trip is not None:
+                    self.trip_times.add(trip)
+                if self.cars_exited == num_cars:
+                    cut = (ts, ev_type, seq)
+                    break
+        for part in parts:
+            part.call('stats_at', cut)
+        for part in parts:
+            total_wait_time, count_waited = part.result()
+            self.total_wait_time += total_wait_time
+            self.count_waited += count_waited
+
+if __name__ == "__main__":
+    import time
+    from traffic_grid import run_replication
+    s = Statistics()
+    s.grid_size = 8
+    s.num_cars = 2000
+    s.car_density = 1
+    s.common_random_numbers = True
+    s.canonical_order = True
+    s.trajectory_sample_rate = 0
+    t0 = time.perf_counter()
+    sequential = run_replication(s, 1)
+    t1 = time.perf_counter()
+    pr = PartitionedRun(s, 1, (2, 2))
+    partitioned = pr.run()
+    t2 = time.perf_counter()
+    print("Sequential:  {} ({:.2f}s)".format(sequential, t1 - t0))
+    print("Partitioned: {} ({:.2f}s, {} windows, {} cars sent)".format(
+        partitioned, t2 - t1, pr.windows, pr.messages))
@@ -0,0 +1,79 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from light_state import LightState, LightState1, LightState2
+from running_stats import RunningStats
+from traffic_grid import Statistics, replication_seeds, run_replication
+
+
+# Compares light policies with common random numbers: replication k of every policy
+# uses the same KeyedRandom seed, so all policies see the same cars arriving at the
+# same inlets and taking the same turns. The differences between policies are then
+# measured per replication (paired), which needs far fewer replications than comparing
+# independent runs.
+class PolicyComparison:
+    def __init__(self, policies=(LightState, LightState1, LightState2), stats=None,
+                 replications=100, seed=0, workers=1):
+        self.policies = list(policies)  # The first one is the baseline
+        self.stats = stats if stats is not None else Statistics()  # Run parameters
+        self.replications = replications
+        self.seed = seed
+        self.workers = workers
+        self.results = None  # Average wait per policy, one list entry per replication
+
+    def run(self):
+        seeds = replication_seeds(self.seed, 0, self.replications)
+        runners = []
+        for policy in self.policies:
+            stats = copy.copy(self.stats)
+            stats.light_state_class = policy
+            stats.common_random_numbers = True
+            runners.append(stats)
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                rows = list(pool.map(run_paired_replication, [runners] * len(seeds), seeds,
+                                     chunksize=max(1, len(seeds) // (self.workers * 4))))
+        else:
+            rows = [run_paired_replication(runners, seed) for seed in seeds]
+        self.results = rows
+        return rows
+
+    def policy_stats(self, p):
+        st = RunningStats()
+        for row in self.results:
+            st.add(row[p])
+        return st
+
+    # Differences policy p - baseline, one per replication
+    def paired_stats(self, p):
+        st = RunningStats()
+        for row in self.results:
+            st.add(row[p] - row[0])
+        return st
+
+    def report(self, confidence=0.95):
+        print("Average wait over %d paired replications:" % len(self.results))
+        for p, policy in enumerate(self.policies):
+            st = self.policy_stats(p)
+            print("  {:<16} {:.4f} +- {:.4f}".format(policy.__name__, st.mean,
+                                                    st.half_width(confidence) or 0))
+        base = self.policy_stats(0)
+        print("Paired differences against %s:" % self.policies[0].__name__)
+        for p in range(1, len(self.policies)):
+            diff = self.paired_stats(p)
+            # Variance the difference would have with independent runs
+            independent = (base.variance() or 0) + (self.policy_stats(p).variance() or 0)
+            paired = diff.variance() or 0
+            print("  {:<16} {:+.4f} +- {:.4f}  (variance reduction x{:.1f})".format(
+                self.policies[p].__name__, diff.mean, diff.half_width(confidence) or 0,
+                independent / paired if paired else float('inf')))
+
+
+# Worker for PolicyComparison.run: one replication of every policy
+def run_paired_replication(runners, seed):
+    return [run_replication(stats, seed) for stats in runners]
+
+
+if __name__ == "__main__":
+    pc = PolicyComparison(replications=50)
+    pc.run()
+    pc.report()
@@ -0,0 +1,196 @@
+import numpy as np
+from constants import CAR_POLYLINES
+from spatial_index import UniformGrid
+
+CAR_CELL_SIZE = 100  # Meters, cells of the index of the car segments
+
+# Poses of all the cars of a Choreographer at time t in a few NumPy passes, instead of a
+# Car.info call per car and a transform call per outline point every frame.
+#
+# The trajectories of the cars (Car.t, x, y, dir) are packed end to end in one array per
+# column, car k owning [start[k], end[k]). Times are searched all at once on keys that
+# shift the times of car k by k * span, so the keys of every car sort after those of the
+# cars before it. The poses are those of Car.info (up to rounding of the shifted keys),
+# except that cars are not shown before their first point: they are not in the grid yet
+# (and a TraceReplay window replays cars ahead of its time).
+#
+# The segments of the trajectories are also indexed by the time layers (of layer_length
+# seconds) and cells they are in, so that finding the cars in a part of the grid at t
+# only looks at the segments of that part around t, however long the run.
+
+OUTLINE = np.array(CAR_POLYLINES, dtype=float).T  # 2 x points, in half widths and lengths
+
+
+class TrajectoryPack:
+    def __init__(self, choreographer, layer_length=10.0):
+        self.choreographer = choreographer
+        cars = [car for car in choreographer.cars.values() if len(car)]
+        self.cids = np.array([car.id for car in cars], dtype=np.int64)
+        lengths = np.array([len(car) for car in cars], dtype=np.int64)
+        self.end = np.cumsum(lengths)
+        self.start = self.end - lengths
+        self.t = np.concatenate([np.frombuffer(car.t, dtype=float) for car in cars] or [[]])
+        self.x = np.concatenate([np.frombuffer(car.x, dtype=float) for car in cars] or [[]])
+        self.y = np.concatenate([np.frombuffer(car.y, dtype=float) for car in cars] or [[]])
+        self.dir = np.concatenate([np.frombuffer(car.dir, dtype=np.int8) for car in cars] or [[]])
+        self.dir = self.dir.astype(float)
+        self.iid = np.concatenate([np.frombuffer(car.iid, dtype=np.int32) for car in cars] or [[]])
+        self.iid = self.iid.astype(np.int64)
+        self.layer_length = layer_length
+        self.segment_arrays = None  # (p, q, t0, t1, layers), see segments
+        self.car_index = None  # UniformGrid of the segments by layer and place, see cars_in
+        self.time_index = None  # UniformGrid of the segments by layer only
+        if len(self.t):
+            self.t_min = self.t.min()
+            span = self.t.max() - self.t_min + 1
+        else:
+            self.t_min = 0
+            span = 1
+        self.shift = np.arange(len(cars)) * span
+        self.keys = self.t - self.t_min + np.repeat(self.shift, lengths)
+
+    def __len__(self):
+        return len(self.cids)
+
+    # Pose of every car at ts, or of the given car indexes only: (car indexes, x, y,
+    # angle) of the cars in the grid at ts, angle as returned by Car.info
+    def poses(self, ts, cars=None):
+        start = self.start
+        last = self.end - 1
+        shift = self.shift
+        if cars is not None:
+            start = start[cars]
+            last = last[cars]
+            shift = shift[cars]
+        t = self.t
+        j = np.searchsorted(self.keys, ts - self.t_min + shift) - 1
+        j = np.maximum(np.minimum(j, last - 1), start)
+
+        before = ts < t[start]
+        after = ts >= t[last]
+        edge = before | after
+        p = np.where(before, start, np.where(after, last, j))
+        q = np.where(edge, p, np.minimum(j + 1, last))
+
+        x0 = self.x[p]
+        x1 = self.x[q]
+        hold = edge | np.isnan(x1)  # No interpolation, the position of p
+        dt = np.where(hold, 1, t[q] - t[p])
+        a1 = np.where(hold, 0, (ts - t[p]) / dt)
+        a0 = 1 - a1
+
+        d0 = self.dir[p] * 90
+        d1 = self.dir[q] * 90
+        d1 = np.where(d0 - d1 > 180, d1 + 360, d1)
+        d0 = np.where(d0 - d1 < -190, d0 + 360, d0)
+        angle = np.where(hold, self.dir[p], a0 * d0 + a1 * d1)
+
+        x = np.where(hold, x0, a0 * x0 + a1 * x1)
+        y = np.where(hold, self.y[p], a0 * self.y[p] + a1 * self.y[q])
+
+        visible = np.flatnonzero(~np.isnan(x0) & ~before)
+        index = visible if cars is None else cars[visible]
+        return index, x[visible], y[visible], angle[visible]
+
+    # Segments of the trajectories, one per point p with a position: the car goes from
+    # p to q = p + 1 from t0 to t1, or stays at q = p (when it is gone at p + 1, or after
+    # its last point, t1 = inf), over the time layers first..last.
+    def segments(self):
+        if self.segment_arrays is None:
+            x = self.x
+            t = self.t
+            n = len(t)
+            p = np.arange(n)
+            last = np.zeros(n, dtype=bool)
+            last[self.end - 1] = True
+            q = np.where(last, p, p + 1)
+            t1 = np.where(last, np.inf, t[q])
+            q = np.where(np.isnan(x[q]), p, q)
+            keep = ~np.isnan(x)
+            p = p[keep]
+            q = q[keep]
+            t0 = t[p]
+            t1 = t1[keep]
+            layers = (self.layer(t0), self.layer(np.minimum(t1, t.max() if n else 0)))
+            self.segment_arrays = (p, q, t0, t1, layers)
+        return self.segment_arrays
+
+    def layer(self, ts):
+        return np.maximum(np.floor((ts - self.t_min) / self.layer_length), 0).astype(np.int64)
+
+    # Indexes of the cars that may be in the rectangle at ts (some are not, none is
+    # missing), for poses
+    def cars_in(self, min_x, min_y, max_x, max_y, ts):
+        p, q, t0, t1, layers = self.segments()
+        if self.car_index is None:
+            x = self.x
+            y = self.y
+            car = np.repeat(np.arange(len(self)), self.end - self.start)
+            self.car_index = UniformGrid(np.minimum(x[p], x[q]), np.minimum(y[p], y[q]),
+                                         np.maximum(x[p], x[q]), np.maximum(y[p], y[q]),
+                                         car[p], CAR_CELL_SIZE, *layers)
+        layer = min(int(self.layer(ts)), int(layers[1].max()) if len(p) else 0)
+        return self.car_index.query(min_x, min_y, max_x, max_y, layer)
+
+    # Indexes (into segments) of the segments with t0 <= ts < t1
+    def segments_at(self, ts):
+        p, q, t0, t1, layers = self.segments()
+        if self.time_index is None:
+            zeros = np.zeros(len(p))
+            self.time_index = UniformGrid(zeros, zeros, zeros, zeros, np.arange(len(p)),
+                                          1.0, *layers)
+        layer = min(int(self.layer(ts)), int(layers[1].max()) if len(p) else 0)
+        found = self.time_index.query(0, 0, 0, 0, layer)
+        return found[(t0[found] <= ts) & (ts < t1[found])]
+
+
+# Cars around every intersection, for drawing a zoomed out grid: at the start of the bin
+# of bin_length seconds of a time, how many cars are on their way to or at each IID
+# (density) and how many of them are waiting, moving slower than waiting_speed m/s
+# (queued). Counted from the segments of the pack in the grid at that time only, and
+# kept for the bin drawn last.
+class IntersectionLoad:
+    def __init__(self, pack, n_intersections, bin_length=5.0, waiting_speed=1.0):
+        self.pack = pack
+        self.n_intersections = n_intersections
+        self.bin_length = bin_length
+        self.waiting_speed = waiting_speed
+        self.bin = None
+        self.counts = None
+
+    # (density, queued) per IID at ts, of the bin starting at or before it
+    def at(self, ts):
+        pack = self.pack
+        b = (ts - pack.t_min) // self.bin_length
+        if b != self.bin:
+            s = pack.t_min + b * self.bin_length
+            p, q, t0, t1, layers = pack.segments()
+            found = pack.segments_at(s)
+            found = found[t1[found] < np.inf]  # Not after the last point
+            p = p[found]
+            q = q[found]
+            iid = pack.iid[q]
+            distance = np.hypot(pack.x[q] - pack.x[p], pack.y[q] - pack.y[p])
+            waiting = (q != p) & (distance < self.waiting_speed * (t1[found] - t0[found]))
+            self.counts = (np.bincount(iid, minlength=self.n_intersections),
+                           np.bincount(iid[waiting], minlength=self.n_intersections))
+            self.bin = b
+        return self.counts
+
+
+# Screen points of the outlines of n cars, n x 2 x points: every car's outline is scaled
+# by its half width and length, rotated by its angle (degrees, as transform) and moved to
+# its screen position with one batched matrix multiply.
+def car_outlines(half_widths, half_lengths, screen_x, screen_y, angle):
+    theta = np.radians(angle)
+    st = np.sin(theta)
+    ct = np.cos(theta)
+    m = np.empty((len(angle), 2, 2))
+    m[:, 0, 0] = half_widths * ct
+    m[:, 0, 1] = half_lengths * st
+    m[:, 1, 0] = half_widths * st
+    m[:, 1, 1] = -half_lengths * ct
+    points = m @ OUTLINE
+    points[:, 0, :] += screen_x[:, None]
+    points[:, 1, :] += screen_y[:, None]
+    return points
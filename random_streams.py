@@ -0,0 +1,66 @@
+import random
+
+# Random number sources of the simulation. Every draw names its purpose and the car
+# (or intersection) it is for, so that a keyed source can give each of them its own
+# stream: with common random numbers two runs of different light policies then see
+# exactly the same demand and the same turns for every car.
+
+# Purposes
+RNG_ROUTE = 0  # Route taken at an intersection (per car)
+RNG_EXIT = 1  # Whether the car goes home after an intersection (per car)
+RNG_ARRIVAL = 2  # Time between this car and the previous arrival (per car)
+RNG_INLET = 3  # Inlet the car enters the grid from (per car)
+RNG_LIGHT = 4  # Light cycle offset (per intersection)
+N_PURPOSES = 5
+
+MASK64 = (1 << 64) - 1
+
+
+# Default source: the shared `random` module, the keys are ignored
+class GlobalRandom:
+    def random(self, purpose, key):
+        return random.random()
+
+    def randint(self, purpose, key, a, b):
+        return random.randint(a, b)
+
+    def choice(self, purpose, key, seq):
+        return random.choice(seq)
+
+    def forget(self, key):
+        pass
+
+
+# Common random numbers: the n-th draw of a purpose for a key is a hash of
+# (seed, purpose, key, n), independent of the order in which cars and intersections
+# draw. Only the draw counters of the keys in use are kept, forget() drops them when a
+# car leaves the grid.
+class KeyedRandom:
+    def __init__(self, seed):
+        self.seed = seed
+        self.draws = {}  # key => draw count per purpose
+
+    def uniform(self, purpose, key, n):
+        # splitmix64 finalizer over the (deterministic) hash of the integer tuple
+        z = (hash((self.seed, purpose, key, n)) + 0x9E3779B97F4A7C15) & MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+        z ^= z >> 31
+        return (z >> 11) * (1.0 / (1 << 53))
+
+    def random(self, purpose, key):
+        counts = self.draws.get(key)
+        if counts is None:
+            counts = self.draws[key] = [0] * N_PURPOSES
+        n = counts[purpose]
+        counts[purpose] = n + 1
+        return self.uniform(purpose, key, n)
+
+    def randint(self, purpose, key, a, b):
+        return a + int(self.random(purpose, key) * (b - a + 1))
+
+    def choice(self, purpose, key, seq):
+        return seq[int(self.random(purpose, key) * len(seq))]
+
+    def forget(self, key):
+        self.draws.pop(key, None)
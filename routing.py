@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+# One movement through an intersection (a row of a mesh such as STANDARD_4WAY_YIELD)
+# with its queue id precomputed
+Route = namedtuple('Route', ['from_d', 'to_d', 'p_take', 'p_stop', 'travel_time',
+                             'behavior', 'qid'])
+
+
+# Immutable, compiled form of a mesh. Intersections with the same routing share a
+# single instance, an intersection overriding its routing gets a new one.
+class CompiledMesh:
+    __slots__ = ('n_from', 'n_to', 'routes', 'qid_to_route', 'route_tables')
+
+    def __init__(self, mesh, n_from, n_to):
+        self.n_from = n_from
+        self.n_to = n_to
+        self.routes = tuple(Route(r[0], r[1], r[2], r[3], r[4], r[5], r[0] * n_to + r[1])
+                            for r in mesh)
+        self.qid_to_route = {}
+        for r in self.routes:
+            self.qid_to_route[r.qid] = r
+        # For every incoming direction: the cumulative probabilities of its routes (in
+        # mesh order) and the routes themselves, so a route is drawn with a single bisect
+        tables = []
+        for d in range(n_from):
+            acc = 0
+            cumulative = []
+            routes = []
+            for r in self.routes:
+                if r.from_d != d:
+                    continue
+                acc += r.p_take
+                cumulative.append(acc)
+                routes.append(r)
+            tables.append((tuple(cumulative), tuple(routes)))
+        self.route_tables = tuple(tables)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    # Returns the mesh rows, e.g. to be edited and compiled again
+    def to_rows(self):
+        return [list(r[:6]) for r in self.routes]
+
+
+compiled_meshes = {}  # (mesh rows, n_from, n_to) => CompiledMesh
+
+
+def compile_mesh(mesh, n_from=4, n_to=4):
+    if isinstance(mesh, CompiledMesh):
+        return mesh
+    key = (tuple(tuple(r[:6]) for r in mesh), n_from, n_to)
+    compiled = compiled_meshes.get(key)
+    if compiled is None:
+        compiled = compiled_meshes[key] = CompiledMesh(mesh, n_from, n_to)
+    return compiled
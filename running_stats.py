@@ -0,0 +1,149 @@
+import math
+import statistics
+
+
+# Quantile of Student's t distribution with df degrees of freedom, from the normal
+# quantile with the Cornish-Fisher expansion (Abramowitz & Stegun 26.7.5). The
+# expansion is poor for 1 and 2 degrees of freedom, which have closed forms.
+def t_quantile(p, df):
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = statistics.NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+# Mergeable approximate quantile sketch (KLL style). Level h holds samples standing
+# for 2**h values each; when a level reaches k samples it is sorted and every other
+# sample is promoted to the next level. Memory is O(k log(n / k)), and as long as
+# fewer than k values were added the sketch is exact.
+class QuantileSketch:
+    def __init__(self, k=200):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.offset = 0  # Alternates between compactions, keeps the sketch deterministic
+
+    def add(self, x):
+        self.levels[0].append(x)
+        self.count += 1
+        if len(self.levels[0]) >= self.k:
+            self.compact()
+
+    def merge(self, other):
+        for h, items in enumerate(other.levels):
+            if h >= len(self.levels):
+                self.levels.append([])
+            self.levels[h].extend(items)
+        self.count += other.count
+        self.compact()
+
+    def compact(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self.k:
+                items = sorted(self.levels[h])
+                # An odd item out stays on its level so no weight is lost
+                self.levels[h] = [items.pop()] if len(items) % 2 else []
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[h + 1].extend(items[self.offset::2])
+                self.offset ^= 1
+            h += 1
+
+    def is_exact(self):
+        return len(self.levels) == 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        weighted = sorted((x, 1 << h) for h, items in enumerate(self.levels) for x in items)
+        total = sum(w for x, w in weighted)
+        target = q * total
+        acc = 0
+        for x, w in weighted:
+            acc += w
+            if acc >= target:
+                return x
+        return weighted[-1][0]
+
+    def median(self):
+        if self.count == 0:
+            return None
+        if self.is_exact():
+            return statistics.median(self.levels[0])
+        return self.quantile(0.5)
+
+
+# Constant memory summary of a stream of values: count, total, exact min/max,
+# Welford mean/variance and a quantile sketch. Summaries built in different processes
+# (or for different intersections) can be combined with merge.
+class RunningStats:
+    def __init__(self, sketch_size=200):
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared distances from the mean
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(sketch_size)
+
+    def add(self, x):
+        self.count += 1
+        self.total += x
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+        self.sketch.add(x)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mean = other.mean
+            self.m2 = other.m2
+        else:
+            n = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / n
+            self.m2 += other.m2 + delta * delta * self.count * other.count / n
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.sketch.merge(other.sketch)
+
+    # Sample variance, None with less than 2 values
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    def stdev(self):
+        v = self.variance()
+        return None if v is None else math.sqrt(v)
+
+    # Half-width of the two sided confidence interval of the mean, None with less
+    # than 2 values
+    def half_width(self, confidence=0.95):
+        stdev = self.stdev()
+        if stdev is None:
+            return None
+        return t_quantile((1 + confidence) / 2, self.count - 1) * stdev / math.sqrt(self.count)
+
+    def median(self):
+        return self.sketch.median()
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
@@ -0,0 +1,72 @@
+import numpy as np
+
+# Uniform grid over the plane, for finding what is inside a rectangle (e.g. the part of
+# the city on screen) without looking at everything else. Every item is given as a box
+# (min_x, min_y, max_x, max_y), a point when min == max, and is listed in every cell of
+# cell_size meters its box touches. Items are numbers, e.g. indexes into other arrays,
+# and may have several boxes.
+#
+# Boxes can also span a range of layers (min_layer, max_layer), e.g. the time bins a
+# moving car is in a cell: a query then only looks at one layer.
+#
+# The (layer, cell, item) entries are kept sorted by layer and cell, rows of cells are
+# contiguous so a query searches two bounds per row of the rectangle.
+
+
+class UniformGrid:
+    def __init__(self, min_x, min_y, max_x, max_y, items, cell_size=100.0, min_layer=None,
+                 max_layer=None):
+        min_x = np.asarray(min_x, dtype=float)
+        min_y = np.asarray(min_y, dtype=float)
+        self.cell_size = cell_size
+        self.origin_x = min_x.min() if len(min_x) else 0.0
+        self.origin_y = min_y.min() if len(min_y) else 0.0
+        cx0, cy0 = self.cell(min_x, min_y)
+        cx1, cy1 = self.cell(np.asarray(max_x, dtype=float), np.asarray(max_y, dtype=float))
+        self.columns = int(cx1.max()) + 1 if len(cx1) else 1
+        self.rows = int(cy1.max()) + 1 if len(cy1) else 1
+
+        if min_layer is None:
+            min_layer = max_layer = np.zeros(len(cx0), dtype=np.int64)
+        min_layer = np.asarray(min_layer, dtype=np.int64)
+        max_layer = np.asarray(max_layer, dtype=np.int64)
+
+        # One entry per cell and layer of every box
+        widths = cx1 - cx0 + 1
+        areas = widths * (cy1 - cy0 + 1)
+        counts = areas * (max_layer - min_layer + 1)
+        box = np.repeat(np.arange(len(counts)), counts)
+        r = np.arange(len(box)) - np.repeat(np.cumsum(counts) - counts, counts)
+        layer = min_layer[box] + r // areas[box]
+        r %= areas[box]
+        keys = ((layer * self.rows + cy0[box] + r // widths[box]) * self.columns +
+                cx0[box] + r % widths[box])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.items = np.asarray(items)[box[order]]
+
+    def __len__(self):
+        return len(self.items)
+
+    def cell(self, x, y):
+        cx = np.floor((x - self.origin_x) / self.cell_size).astype(np.int64)
+        cy = np.floor((y - self.origin_y) / self.cell_size).astype(np.int64)
+        return cx, cy
+
+    # Items with a box touching a cell of the rectangle in layer, each once, sorted
+    def query(self, min_x, min_y, max_x, max_y, layer=0):
+        cx0, cy0 = self.cell(min_x, min_y)
+        cx1, cy1 = self.cell(max_x, max_y)
+        cx0 = max(int(cx0), 0)
+        cy0 = max(int(cy0), 0)
+        cx1 = min(int(cx1), self.columns - 1)
+        cy1 = min(int(cy1), self.rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return self.items[:0]
+        rows = (layer * self.rows + np.arange(cy0, cy1 + 1)) * self.columns
+        lo = np.searchsorted(self.keys, rows + cx0, 'left')
+        hi = np.searchsorted(self.keys, rows + cx1, 'right')
+        found = [self.items[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if a < b]
+        if not found:
+            return self.items[:0]
+        return np.unique(np.concatenate(found))
@@ -0,0 +1,79 @@
+import random
+import numpy as np
+from binary_trace import TraceWriter, TraceReplay
+from choreographer import Choreographer
+from pose_engine import TrajectoryPack
+from traffic_grid import TrafficGrid, MergedArrivals, UniformGaps
+
+
+def run(make_choreographer, seed=5, size=5, num_cars=800):
+    random.seed(seed)
+    tr = TrafficGrid(num_cars, False)
+    tr.choreographer = make_choreographer(tr)
+    tr.generate_grid(size, size)
+    tr.add_arrivals(MergedArrivals(tr.inlets, num_cars, UniformGaps(2), tr.rng))
+    tr.event_loop()
+    return tr
+
+
+# Runs the same simulation with a TraceWriter in place of the Choreographer
+def write_trace(path, **options):
+    writers = []
+
+    def writer(tr):
+        writers.append(TraceWriter(tr, path, **options))
+        return writers[0]
+
+    tr = run(writer)
+    writers[0].close()
+    return tr
+
+
+# Replaying the trace of a run gives the poses the Choreographer of the same run kept
+# in memory, at any time and whatever windows were replayed before
+def test_trace_replays_the_poses_of_the_run(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    memory = run(Choreographer)
+    traced = write_trace(path, checkpoint_interval=120)
+    replay = TraceReplay(path, window_length=40)
+    try:
+        assert [None if io is None else (io.pos_x, io.pos_y, io.is_inlet())
+                for io in replay.intersections] == \
+               [None if io is None else (io.pos_x, io.pos_y, io.is_inlet())
+                for io in traced.intersections]
+        cars = memory.choreographer.cars
+        end = replay.end_time()
+        times = list(np.arange(0, end, 6.5)) + list(np.arange(end, 0, -23.0))
+        checked = 0
+        for t in times:
+            window = replay.window_at(t)
+            for cid, car in cars.items():
+                if car.t[0] > t:
+                    continue
+                pose = car.info(t)
+                if pose is not None:
+                    checked += 1
+                assert (window.cars[cid].info(t) if cid in window.cars else None) == pose
+        assert checked > 10000
+    finally:
+        replay.close()
+
+
+# The packed poses of a replay window are those of the run in memory
+def test_packed_poses_of_a_window(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    memory = TrajectoryPack(run(Choreographer).choreographer)
+    write_trace(path)
+    replay = TraceReplay(path)
+    try:
+        for t in (15.0, 130.5, 400.0):
+            pack = TrajectoryPack(replay.window_at(t))
+            index, x, y, angle = pack.poses(t)
+            expected = memory.poses(t)
+            got = dict(zip(pack.cids[index].tolist(), zip(x, y, angle)))
+            want = dict(zip(memory.cids[expected[0]].tolist(), zip(*expected[1:])))
+            assert got.keys() == want.keys()
+            for cid in want:
+                assert np.allclose(got[cid], want[cid])
+    finally:
+        replay.close()
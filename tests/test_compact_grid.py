@@ -0,0 +1,44 @@
+import pytest
+from compact_grid import generate_compact_grid
+from light_state import LightState, LightState1
+from random_streams import KeyedRandom
+from traffic_grid import TrafficGrid, MergedArrivals, UniformGaps
+
+
+def run(light_state_class, compact, seed=1, size=6, num_cars=400):
+    tr = TrafficGrid(num_cars, False, rng=KeyedRandom(seed), light_state_class=light_state_class,
+                     canonical_order=True)
+    if compact:
+        generate_compact_grid(tr, size, size)
+    else:
+        tr.generate_grid(size, size)
+    tr.add_arrivals(MergedArrivals(tr.inlets, num_cars, UniformGaps(10), tr.rng))
+    tr.event_loop()
+    return tr
+
+
+# Lights created when the first car gets there are in the phase they would have on the
+# full grid, so both grids run the same simulation
+@pytest.mark.parametrize('light_state_class', [LightState, LightState1])
+def test_compact_grid_waits_like_full_grid(light_state_class):
+    full = run(light_state_class, False)
+    compact = run(light_state_class, True)
+    assert compact.count_waited == full.count_waited
+    assert compact.total_wait_time == full.total_wait_time
+
+
+def test_events_never_go_back_in_time():
+    tr = TrafficGrid(300, False, rng=KeyedRandom(2), light_state_class=LightState1)
+    generate_compact_grid(tr, 10, 10)
+    popped = []
+    pop = tr.events.pop
+
+    def recording_pop():
+        ev = pop()
+        popped.append(ev[0])
+        return ev
+
+    tr.events.pop = recording_pop
+    tr.add_arrivals(MergedArrivals(tr.inlets, 300, UniformGaps(2), tr.rng))
+    tr.event_loop()
+    assert all(a <= b for a, b in zip(popped, popped[1:]))
@@ -0,0 +1,66 @@
+import random
+import pytest
+from event_queue import Event, HeapEventQueue, CalendarEventQueue
+from traffic_grid import Statistics, run_replication
+
+
+# Pushes and pops at random, never pushing before the last popped ts (as the event
+# loop), sometimes far ahead into the overflow heap, and returns the events popped
+def drain(queue, seed, n=5000):
+    r = random.Random(seed)
+    popped = []
+    now = 0
+    seq = 0
+    for i in range(n):
+        for j in range(r.randint(0, 3)):
+            gap = r.choice([0, 0, 1, r.randint(2, 40), r.randint(100, 2000)])
+            queue.push(Event(now + gap, r.randint(1, 4), seq, None))
+            seq += 1
+        if len(queue) and r.random() < 0.6:
+            ev = queue.pop()
+            now = ev.ts
+            popped.append(ev)
+    while len(queue):
+        popped.append(queue.pop())
+    return popped
+
+
+@pytest.mark.parametrize('n_buckets', [1, 16, 256])
+def test_calendar_queue_pops_like_heap_queue(n_buckets):
+    for seed in range(5):
+        calendar = drain(CalendarEventQueue(n_buckets), seed)
+        assert calendar == drain(HeapEventQueue(), seed)
+        assert all(a.ts <= b.ts for a, b in zip(calendar, calendar[1:]))
+
+
+# Light offsets are pushed before the current time while the grid is being built
+def test_calendar_queue_rewinds():
+    queue = CalendarEventQueue(8)
+    heap = HeapEventQueue()
+    for seq, ts in enumerate([50, 52, 60, 3, 58, 0, 7, 200, 1]):
+        ev = Event(ts, 1, seq, None)
+        queue.push(ev)
+        heap.push(ev)
+        assert queue.peek() == heap.peek()
+    assert [queue.pop() for i in range(9)] == [heap.pop() for i in range(9)]
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_calendar_queue_needs_integer_timestamps():
+    with pytest.raises(TypeError):
+        CalendarEventQueue().push(Event(1.5, 1, 0, None))
+
+
+def test_simulation_does_not_depend_on_the_queue():
+    s = Statistics()
+    s.grid_size = 5
+    s.num_cars = 300
+    s.car_density = 3
+    s.common_random_numbers = True
+    s.canonical_order = True
+    results = []
+    for event_queue in (HeapEventQueue, CalendarEventQueue):
+        s.event_queue = event_queue
+        results.append(run_replication(s, 4))
+    assert results[0] == results[1]
@@ -0,0 +1,33 @@
+import os
+import pytest
+from test_binary_trace import write_trace
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import frame_export
+from frame_export import FrameExporter
+
+
+# A frame only depends on its time, whatever worker and task range renders it. The
+# step lines up with neither the replay windows nor the tasks. Views: the whole grid
+# (heatmap) and the cars around the middle intersection.
+@pytest.mark.parametrize('screen_scale, screen_offset', [(None, (0, 0)), (1.0, (400, 400))])
+def test_frames_do_not_depend_on_the_worker_count(tmp_path, monkeypatch, screen_scale,
+                                                  screen_offset):
+    trace = str(tmp_path / 'trace.bin')
+    write_trace(trace)
+    monkeypatch.setattr(frame_export, 'FRAMES_PER_TASK', 7)
+    frames = []
+    for workers in (2, 1):  # Workers forked before this process has an Animator
+        out = str(tmp_path / 'frames{}.rgb'.format(workers))
+        exporter = FrameExporter(trace, out, step=3.7, start=0, end=150, screen_size=(160, 120),
+                                 screen_scale=screen_scale, screen_offset=screen_offset,
+                                 raw=True, workers=workers)
+        n = exporter.run()
+        with open(out, 'rb') as f:
+            frames.append(f.read())
+        assert len(frames[-1]) == n * exporter.frame_size()
+    assert n == 41
+    assert frames[0] == frames[1]
+    size = exporter.frame_size()
+    assert len(set(frames[0][k * size:(k + 1) * size] for k in range(n))) > 1
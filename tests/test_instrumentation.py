@@ -0,0 +1,26 @@
+from instrumentation import EventLoopProfiler
+from random_streams import KeyedRandom
+from traffic_grid import TrafficGrid, MergedArrivals, UniformGaps
+
+
+def run(profiler=None, seed=3, size=6, num_cars=400):
+    tr = TrafficGrid(num_cars, False, rng=KeyedRandom(seed), canonical_order=True)
+    tr.profiler = profiler
+    tr.generate_grid(size, size)
+    tr.add_arrivals(MergedArrivals(tr.inlets, num_cars, UniformGaps(5), tr.rng))
+    tr.event_loop()
+    return tr
+
+
+# The profiler wraps the handlers of the grid's own loop, the run is unchanged
+def test_profiled_run_is_the_plain_run():
+    plain = run()
+    profiler = EventLoopProfiler()
+    profiled = run(profiler)
+    assert profiled.count_waited == plain.count_waited
+    assert profiled.total_wait_time == plain.total_wait_time
+    assert profiled.last_event_ts == plain.last_event_ts
+    assert profiler.stale_skipped == plain.stale_light_changes
+    assert sum(profiler.events.values()) == profiler.popped
+    assert set(profiler.handler_time) == set(profiler.events)
+    assert 0 < profiler.average_queue_size() <= profiler.max_queue_size
@@ -0,0 +1,32 @@
+import pytest
+from light_state import LightState1, LightState2
+from partitioned import PartitionedRun
+from traffic_grid import Statistics, run_replication
+
+
+def statistics(light_state_class, grid_size, num_cars, car_density):
+    s = Statistics()
+    s.grid_size = grid_size
+    s.num_cars = num_cars
+    s.car_density = car_density
+    s.light_state_class = light_state_class
+    s.common_random_numbers = True
+    s.canonical_order = True
+    return s
+
+
+@pytest.mark.parametrize('light_state_class', [LightState1, LightState2])
+@pytest.mark.parametrize('grid_size, partitions, num_cars, car_density',
+                         [(3, (2, 2), 100, 10), (5, (2, 3), 300, 3), (6, (1, 6), 400, 2)])
+def test_partitioned_run_is_the_sequential_run(light_state_class, grid_size, partitions,
+                                                num_cars, car_density):
+    s = statistics(light_state_class, grid_size, num_cars, car_density)
+    for seed in (1, 7):
+        run = PartitionedRun(s, seed, partitions, processes=False)
+        assert run.run() == run_replication(s, seed)
+
+
+def test_partition_processes_match_inline_partitions():
+    s = statistics(LightState2, 5, 300, 2)
+    inline = PartitionedRun(s, 3, (2, 2), processes=False).run()
+    assert PartitionedRun(s, 3, (2, 2), processes=True).run() == inline == run_replication(s, 3)
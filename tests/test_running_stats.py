@@ -0,0 +1,73 @@
+import bisect
+import math
+import random
+import statistics
+import pytest
+from running_stats import RunningStats, t_quantile
+
+
+def values(seed, n):
+    r = random.Random(seed)
+    return [r.expovariate(0.2) for i in range(n)]
+
+
+# Summaries of parts of a stream merged in any grouping describe the whole stream
+def test_merge_is_the_whole_stream():
+    xs = values(1, 1000)
+    whole = RunningStats()
+    for x in xs:
+        whole.add(x)
+    parts = [RunningStats() for i in range(4)]
+    for i, x in enumerate(xs):
+        parts[i * 7 % 4].add(x)
+    merged = RunningStats()
+    merged.merge(RunningStats())  # Empty summaries change nothing
+    for part in parts:
+        merged.merge(part)
+    assert merged.count == whole.count == len(xs)
+    assert merged.total == pytest.approx(sum(xs))
+    assert merged.min == whole.min == min(xs)
+    assert merged.max == whole.max == max(xs)
+    assert merged.mean == pytest.approx(statistics.mean(xs))
+    assert merged.variance() == pytest.approx(statistics.variance(xs))
+    assert whole.variance() == pytest.approx(statistics.variance(xs))
+
+
+def test_sketch_is_exact_below_its_size():
+    xs = values(2, 199)
+    s = RunningStats(200)
+    for x in xs[:100]:
+        s.add(x)
+    other = RunningStats(200)
+    for x in xs[100:]:
+        other.add(x)
+    s.merge(other)
+    assert s.sketch.is_exact()
+    assert s.median() == statistics.median(xs)
+
+
+# Rank error of the quantiles of a KLL sketch grows with log(n / k) / k: within 2 / k
+# of the exact rank for 100000 values merged from several summaries, keeping fewer than
+# k log2(n / k) of them
+@pytest.mark.parametrize('k', [50, 200])
+def test_sketch_error_bound(k):
+    for seed in range(3):
+        xs = values(seed, 100000)
+        parts = [RunningStats(k) for i in range(7)]
+        for i, x in enumerate(xs):
+            parts[i % 7].add(x)
+        s = RunningStats(k)
+        for part in parts:
+            s.merge(part)
+        assert sum(len(items) for items in s.sketch.levels) < k * math.log2(len(xs) / k)
+        xs.sort()
+        for q in [i / 100 for i in range(1, 100)]:
+            rank = bisect.bisect_left(xs, s.quantile(q)) / len(xs)
+            assert abs(rank - q) <= 2 / k
+
+
+def test_t_quantile():
+    assert t_quantile(0.975, 1) == pytest.approx(12.706, abs=1e-3)
+    assert t_quantile(0.975, 2) == pytest.approx(4.303, abs=1e-3)
+    assert t_quantile(0.975, 9) == pytest.approx(2.262, abs=1e-3)
+    assert t_quantile(0.975, 1000) == pytest.approx(1.962, abs=1e-3)
@@ -0,0 +1,76 @@
+from collections import deque
+from light_state import EV_CAR_STOPPED, EV_CAR_ENTER_INTERSECTION, EV_LIGHT_CHANGE, EV_DEQUEUE_GREEN
+
+DIRECTION_NAMES = ['North', 'East', 'South', 'West']
+
+# Trace records that are not events, written by the intersections
+TR_CAR_QUEUED = 5  # The car stops and joins the queue of arg (qid)
+TR_CAR_PASSED = 6  # The car goes through without stopping, towards arg (direction)
+
+TRACE_FORMAT_STRINGS = {
+    EV_CAR_STOPPED: "Car {cid} stopped after passing intersection #{iid}",
+    EV_CAR_ENTER_INTERSECTION: "Car {cid} approaches intersection #{iid} from {direction}",
+    EV_LIGHT_CHANGE: "{arg} at #{iid}",
+    EV_DEQUEUE_GREEN: "Car {cid} leaves intersection #{iid} slowly going {direction}",
+    TR_CAR_QUEUED: "Car {cid} stops at intersection #{iid}",
+    TR_CAR_PASSED: "Car {cid} passes intersection #{iid} fast, to {direction}",
+}
+
+
+# Collects (ts, kind, cid, iid, arg) records of a run as plain tuples, kind is an event
+# type or a TR_* constant and cid is None for light changes. Only the records of the
+# given sets of iids, cids and kinds are kept (None keeps all), so tracing one
+# intersection of a large grid costs a set lookup per event. Records are only turned
+# into text when read (lines, dump), or right away with echo.
+#
+# max_records keeps only the latest records (0 keeps none, e.g. with echo).
+class TraceSink:
+    def __init__(self, iids=None, cids=None, kinds=None, max_records=None, echo=False):
+        self.iids = set(iids) if iids is not None else None
+        self.cids = set(cids) if cids is not None else None
+        self.kinds = set(kinds) if kinds is not None else None
+        self.records = deque(maxlen=max_records)
+        self.echo = echo
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def record(self, ts, kind, cid, iid, arg):
+        if self.iids is not None and iid not in self.iids:
+            return
+        if self.cids is not None and cid not in self.cids:
+            return
+        if self.kinds is not None and kind not in self.kinds:
+            return
+        rec = (ts, kind, cid, iid, arg)
+        self.records.append(rec)
+        if self.echo:
+            print(self.format(rec))
+
+    # Event popped by the event loop
+    def event(self, ts, ev_type, payload):
+        if ev_type == EV_LIGHT_CHANGE:
+            self.record(ts, ev_type, None, payload[1], payload[0])
+        else:
+            self.record(ts, ev_type, payload[0], payload[1], payload[2])
+
+    def format(self, rec):
+        ts, kind, cid, iid, arg = rec
+        # For dequeues arg is the qid, whose remainder is the outgoing direction
+        direction = DIRECTION_NAMES[arg % 4] if kind != EV_LIGHT_CHANGE else None
+        return "{:>3}: ".format(ts) + TRACE_FORMAT_STRINGS[kind].format(
+            cid=cid, iid=iid, arg=arg, direction=direction)
+
+    def lines(self):
+        for rec in self.records:
+            yield self.format(rec)
+
+    def dump(self, file=None):
+        for line in self.lines():
+            print(line, file=file)
+
+    def clear(self):
+        self.records.clear()
@@ -1,10 +1,17 @@
 import json
 import random
-import copy
-import heapq
-import statistics
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_right
 from choreographer import Choreographer
+from routing import compile_mesh
+from running_stats import RunningStats
+from random_streams import GlobalRandom, KeyedRandom, RNG_ROUTE, RNG_EXIT
+from arrivals import MergedArrivals, UniformGaps
+from car_queue import CarQueue
+from event_queue import Event, HeapEventQueue
 from light_state import LightState2 as LightState
+from tracing import DIRECTION_NAMES, TraceSink, TR_CAR_QUEUED, TR_CAR_PASSED
 
 # import numpy as np
 
@@ -23,7 +30,11 @@ from light_state import LightState2 as LightState
 #              |
 #             (2)
 #              |
-DIRECTION_NAMES = ['North', 'East', 'South', 'West']
+# DIRECTION_NAMES (imported from tracing) gives their names
+
+# Axes of the incoming directions (direction % 2)
+AXIS_NS = 0
+AXIS_EW = 1
 
 # Behavior names
 U_TURN = 0
@@ -51,6 +62,7 @@ STANDARD_4WAY_YIELD = [
     [3, 1, 0.65, 0, 50, DEFAULT],
     [3, 2, 0.15, 0, 50, YIELD_LEFT],
 ]
+STANDARD_4WAY_MESH = compile_mesh(STANDARD_4WAY_YIELD)  # Shared by default intersections
 
 # Events
 EV_ALL_STOP = -1
@@ -59,49 +71,86 @@ EV_CAR_ENTER_INTERSECTION = 2
 EV_LIGHT_CHANGE = 3
 EV_DEQUEUE_GREEN = 4  # This is the slow de-queuing of a light just turned green
 
-EVENT_FORMAT_STRINGS = [
-    "",
-    "Car {0} stopped after passing intersection #{1}",
-    "Car {0} approaches intersection #{1} from direction{2}",
-    "{0} at #{1}",
-    "Car {0} leaves intersection #{1} slowly going direction{2}"
-]
-
 # Some time constants (in seconds)
 TS_FIRST_DEQUEUE_DELAY = 2
 TS_NEXT_DEQUEUE_DELAY = 2
 
 
 class Intersection:
-    def __init__(self, iid, grid, pdata, mesh=STANDARD_4WAY_YIELD):
+    to_dir_lookup = (2, 3, 0, 1)  # Leaving 0, arriving 2 etc.
+
+    def __init__(self, iid, grid, mesh=STANDARD_4WAY_MESH):
         super()
         self.iid = iid
-        self.pdata = pdata
         self.grid = grid
         self.n_from = 4
         self.n_to = 4
         self.from_iids = [None] * self.n_from
         self.to_iids = [None] * self.n_to
-        self.to_dir_lookup = [2, 3, 0, 1]  # Leaving 0, arriving 2 etc.
-        self.mesh = copy.deepcopy(mesh)
+        self.mesh = None
+        self.set_mesh(mesh)
         self.intersection_state = None
-        self.outgoing_queue = [[] for i in range(self.n_from * self.n_to)]
-        self.qid_to_route = self.build_qid_lookup()
+        self.outgoing_queue = [CarQueue() for i in range(self.n_from * self.n_to)]
+        # Cars queued per axis of the incoming direction, kept up to date on enqueue/dequeue
+        self.axis_queue_len = [0, 0]
+        self.axis_watchers = None  # [axis, threshold, callback] from watch_axis_queue
         self.pos_x = 0
         self.pos_y = 0
-        self.light_state = LightState(self)
+        self.light_state = grid.light_state_class(self)
 
     def set_position(self, x, y):
         self.pos_x = x
         self.pos_y = y
 
-    def build_qid_lookup(self):
-        h = {}
-        for r in self.mesh:
-            qid = r[0] * self.n_to + r[1]
-            h[qid] = r
-
-        return h
+    # The mesh is a CompiledMesh shared with every intersection routing the same way,
+    # it is never modified in place: overriding the routing compiles a new one
+    def set_mesh(self, mesh):
+        self.mesh = compile_mesh(mesh, self.n_from, self.n_to)
+
+    # Replaces fields (p_take, p_stop, travel_time, behavior) of one route of this
+    # intersection only
+    def override_route(self, from_d, to_d, **fields):
+        rows = self.mesh.to_rows()
+        for row in rows:
+            if row[0] == from_d and row[1] == to_d:
+                for i, name in enumerate(['p_take', 'p_stop', 'travel_time', 'behavior']):
+                    if name in fields:
+                        row[i + 2] = fields[name]
+        self.set_mesh(rows)
+
+    # callback(ts, intersection, axis, count, rising) is called whenever the number of
+    # cars queued on axis crosses threshold, rising is True when it reaches threshold
+    # and False when it drops below it again
+    def watch_axis_queue(self, axis, threshold, callback):
+        if self.axis_watchers is None:
+            self.axis_watchers = []
+        self.axis_watchers.append([axis, threshold, callback])
+
+    def notify_axis_watchers(self, ts, axis, old, new):
+        for w_axis, threshold, callback in self.axis_watchers:
+            if w_axis != axis:
+                continue
+            if old < threshold <= new:
+                callback(ts, self, axis, new, True)
+            elif new < threshold <= old:
+                callback(ts, self, axis, new, False)
+
+    def enqueue(self, ts, cid, route):
+        self.outgoing_queue[route.qid].append(ts, cid, route[0], route[1])
+        axis = route[0] & 1
+        n = self.axis_queue_len[axis]
+        self.axis_queue_len[axis] = n + 1
+        if self.axis_watchers:
+            self.notify_axis_watchers(ts, axis, n, n + 1)
+
+    def dequeue(self, ts, qid):
+        item = self.outgoing_queue[qid].popleft()
+        axis = (qid // self.n_to) & 1
+        n = self.axis_queue_len[axis]
+        self.axis_queue_len[axis] = n - 1
+        if self.axis_watchers:
+            self.notify_axis_watchers(ts, axis, n, n - 1)
+        return item
 
     def assign_from_iid(self, d, iid):
         self.from_iids[d] = iid
@@ -110,40 +159,32 @@ class Intersection:
         self.to_iids[d] = iid
 
     def incoming_traffic(self, ts, d, cid):
-        # First determine where this car will go:
-        ran = random.random()
-        ran_acc = 0
-        found_route = None
-        for route in self.mesh:
-            if route[0] != d:
-                continue
-            ran_acc += route[2]
-            if ran >= ran_acc:  # Not taken
-                continue
-            found_route = route
-            break
-        qid = found_route[0] * self.n_to + found_route[1]
+        # First determine where this car will go: the first route whose cumulative
+        # probability exceeds the random number
+        cumulative, routes = self.mesh.route_tables[d]
+        found_route = routes[bisect_right(cumulative, self.grid.rng.random(RNG_ROUTE, cid))]
+        qid = found_route.qid
         is_red = self.light_state.is_red_at_time(ts, d, qid)
         state = 0  # pass
         if is_red or self.outgoing_queue[qid]:
-            if self.pdata:
-                print("{}: Car {} stops".format(ts, cid))
+            if self.grid.trace is not None:
+                self.grid.trace.record(ts, TR_CAR_QUEUED, cid, self.iid, qid)
             self.grid.car_last_stop[cid] = ts
             # Enter the queue
-            item = [ts, cid, found_route[0], found_route[1]]
-            self.outgoing_queue[qid].append(item)  # Queue will take care of this car
+            self.enqueue(ts, cid, found_route)
         else:
             self.grid.count_waited += 1
+            if self.grid.intersection_stats is not None:
+                self.grid.record_wait(self.iid, 0)
             # No queue, just go through full speed
-            if self.pdata:
-                print("{}: Car {} passes intersection #{} fast, to {}"
-                      .format(ts, cid, self.iid, DIRECTION_NAMES[found_route[1]]))
+            if self.grid.trace is not None:
+                self.grid.trace.record(ts, TR_CAR_PASSED, cid, self.iid, found_route[1])
             self.go_to_next_intersection(ts, cid, found_route)
         return found_route[1], state
 
     def go_to_next_intersection(self, ts, cid, found_route):
         # Check if the car will "go home"
-        ran2 = random.random()
+        ran2 = self.grid.rng.random(RNG_EXIT, cid)
         if ran2 < found_route[3]:  # Car got home
             stop_time = ts + round(found_route[4] * ran2 / found_route[3])
             self.grid.add_event(EV_ALL_STOP, stop_time, True,
@@ -158,28 +199,34 @@ class Intersection:
 
     def light_change(self, ts, to_state):
         to_phase = self.light_state.phases[to_state]
-        for route in self.mesh:
-            qid = route[0] * self.n_to + route[1]
+        for route in self.mesh.routes:
+            qid = route.qid
             if to_phase[qid % 8] == 1:
                 continue  # Routes blocked by red will not dequeue
             if self.outgoing_queue[qid]:
-                cid = self.outgoing_queue[qid][0][1]  # Peek only
+                cid = self.outgoing_queue[qid].peek_cid()
                 self.grid.add_event(EV_DEQUEUE_GREEN, ts + TS_FIRST_DEQUEUE_DELAY, True,
                                     (cid, self.iid, qid))
         self.grid.add_event(EV_LIGHT_CHANGE, ts + to_phase[8],
                             True, ((to_state + 1) % len(self.light_state.phases), self.iid))
         self.light_state.state = to_state
 
+    # Lets the car at the head of the queue go. cid is the car that was at the head when
+    # the event was scheduled, another dequeue chain of the same queue may have let it go
+    # already, so the car actually leaving is the one popped.
     def dequeue_green(self, ts, cid, qid):
         if len(self.outgoing_queue[qid]) == 0:
             return
-        item = self.outgoing_queue[qid].pop(0)
-        self.go_to_next_intersection(ts, cid, self.qid_to_route[qid])
-        duration = ts - self.grid.car_last_stop[cid]
+        item = self.dequeue(ts, qid)
+        cid = item[1]
+        self.go_to_next_intersection(ts, cid, self.mesh.qid_to_route[qid])
+        duration = ts - self.grid.car_last_stop.pop(cid)
         self.grid.total_wait_time += duration
         self.grid.count_waited += 1
+        if self.grid.intersection_stats is not None:
+            self.grid.record_wait(self.iid, duration)
         if self.outgoing_queue[qid]:
-            cid = self.outgoing_queue[qid][0][1]
+            cid = self.outgoing_queue[qid].peek_cid()
             self.grid.add_event(EV_DEQUEUE_GREEN, ts + TS_NEXT_DEQUEUE_DELAY, True,
                                 (cid, self.iid, qid))
         return item
@@ -204,16 +251,72 @@ class Inlet:
         self.pos_y = y
 
 
+# Yields (iid, pos_x, pos_y, to_iid, to_dir) for every cell of an m x n grid surrounded
+# by inlets. to_iid and to_dir are None for intersections (their neighbours are given by
+# grid_neighbours), for inlets they tell where the cars enter the grid.
+def grid_layout(m, n):
+    for i in range(m + 2):
+        for j in range(n + 2):
+            iid = i + j * (m + 2)
+            if 0 < i < m + 1 and 0 < j < n + 1:
+                yield iid, i * 400 - 800, j * 400 - 800, None, None
+            # this section deals with inlets NOTE: only inlets are at the edges of the grid
+            else:
+                pos_x = (i - 2) * 400
+                pos_y = (j - 2) * 400
+                if (i == 0 or i == m + 1) and (j == 0 or j == n + 1):
+                    continue  # Nothing at the corners
+                if i == 0:
+                    pos_x = 0
+                    to_iid = iid + 1
+                    d = 1
+                elif i == m + 1:
+                    pos_x = 1200
+                    to_iid = iid - 1
+                    d = 3
+                elif j == 0:
+                    pos_y = 0
+                    to_iid = iid + m + 2
+                    d = 0
+                else:
+                    pos_y = 1200
+                    to_iid = iid - (m + 2)
+                    d = 2
+                yield iid, pos_x, pos_y, to_iid, d
+
+
+# IIDs in direction 0..3 of an intersection, both for incoming and outgoing traffic
+def grid_neighbours(iid, m):
+    return iid - (m + 2), iid - 1, iid + (m + 2), iid + 1
+
+
 class TrafficGrid:
-    def __init__(self, num_cars, pdata, choreographer=None):
+    # num_cars is the number of cars to see leaving the grid before stopping, None means
+    # every car the arrival processes (which must then be finite) produce
+    # With canonical_order, events with the same ts and type are ordered by canonical_seq
+    # instead of the order they were added in, see partitioned.py
+    def __init__(self, num_cars, pdata, choreographer=None, event_queue=None, rng=None,
+                 light_state_class=None, canonical_order=False):
         super()
         self.pdata = pdata
-        self.num_cars = num_cars
-        self.events = []
-        self.marking = []
+        self.wait_for_arrivals = num_cars is None
+        self.num_cars = num_cars if num_cars is not None else float('inf')
+        self.arrival_sources = []  # Iterators of the arrival processes
+        self.open_sources = 0
+        self.cars_spawned = 0
+        # Source of every random draw, a KeyedRandom gives common random numbers
+        self.rng = rng if rng is not None else GlobalRandom()
+        self.light_state_class = light_state_class if light_state_class is not None else LightState
+        # HeapEventQueue handles any timestamp, CalendarEventQueue is faster for integer ones
+        self.events = event_queue if event_queue is not None else HeapEventQueue()
+        self.next_seq = 0  # Sequence number of the next event, breaks ties in the queue
+        self.light_change_tokens = {}  # iid => seq of the only light change still valid
+        self.stale_light_changes = 0  # Superseded light changes skipped by the event loop
+        self.canonical_order = canonical_order
+        self.light_changes_added = {}  # iid => light changes added so far, canonical order only
         self.inlets = []
         self.outlets = []
-        self.intersections = []
+        self.intersections = []  # Indexed by IID, a list or a CompactGrid
         self.last_event_ts = 0
         self.event_handlers = {
             EV_CAR_STOPPED: None,
@@ -222,9 +325,30 @@ class TrafficGrid:
             EV_DEQUEUE_GREEN: self.efn_dequeue_green,
         }
         self.choreographer = choreographer
-        self.car_last_stop = {}  # cid => ts of the last time car stops
+        # TraceSink recording events (see tracing.py), pdata echoes those of intersection #16
+        self.trace = TraceSink(iids={16}, max_records=0, echo=True) if pdata else None
+        self.profiler = None  # Runs the event loop instead when set, see instrumentation.py
+        # Per-car state only lives while the car is in the grid (see finalize_car)
+        self.car_last_stop = {}  # cid => ts the car stopped, while it is queued
+        self.car_entry_ts = {}  # cid => ts the car entered the grid from an arrival process
+        self.cars_exited = 0
+        self.trip_times = RunningStats()  # Time in the grid of the cars that left it
         self.total_wait_time = 0
         self.count_waited = 0
+        self.intersection_stats = None  # iid => RunningStats of wait times, when tracked
+        self.stats_sketch_size = 0
+
+    # Also keeps wait time statistics (cars passing without stopping wait 0) per
+    # intersection, in constant memory per intersection
+    def track_intersection_stats(self, sketch_size=64):
+        self.intersection_stats = {}
+        self.stats_sketch_size = sketch_size
+
+    def record_wait(self, iid, duration):
+        st = self.intersection_stats.get(iid)
+        if st is None:
+            st = self.intersection_stats[iid] = RunningStats(self.stats_sketch_size)
+        st.add(duration)
 
     def load(self, file):
         with open(file, 'r') as fp:
@@ -242,101 +366,144 @@ class TrafficGrid:
             }
             json.dump(data, fp)
 
-    def generate_grid(self, m, n):
+    # owns(iid) returning False leaves that intersection out (None), the inlets are
+    # always created
+    def generate_grid(self, m, n, owns=None):
         self.intersections = [None] * ((m + 2) * (n + 2))
-        for i in range(m + 2):
-            for j in range(n + 2):
-                iid = i + j * (m + 2)
-                if 0 < i < m + 1 and 0 < j < n + 1:
-                    io = Intersection(iid, self, self.pdata and iid == 16)
-                    io.set_position(i * 400 - 800, j * 400 - 800)
-                    io.assign_from_iid(0, iid - (m + 2))
-                    io.assign_from_iid(1, iid - 1)
-                    io.assign_from_iid(2, iid + (m + 2))
-                    io.assign_from_iid(3, iid + 1)
-                    io.assign_to_iid(0, iid - (m + 2))
-                    io.assign_to_iid(1, iid - 1)
-                    io.assign_to_iid(2, iid + (m + 2))
-                    io.assign_to_iid(3, iid + 1)
-                # this section deals with inlets NOTE: only inlets are at the edges of the grid
-                else:
-                    pos_x = (i - 2) * 400
-                    pos_y = (j - 2) * 400
-                    if (i == 0 or i == m + 1) and (j == 0 or j == n + 1):
-                        continue  # Nothing at the corners
-                    if i == 0:
-                        pos_x = 0
-                        to_iid = iid + 1
-                        d = 1
-                    elif i == m + 1:
-                        pos_x = 1200
-                        to_iid = iid - 1
-                        d = 3
-                    elif j == 0:
-                        pos_y = 0
-                        to_iid = iid + m + 2
-                        d = 0
-                    else:
-                        pos_y = 1200
-                        to_iid = iid - (m + 2)
-                        d = 2
-                    io = Inlet(iid, to_iid, d)
-                    io.set_position(pos_x, pos_y)
-                    self.inlets.append(io)
-                self.intersections[iid] = io
+        for iid, pos_x, pos_y, to_iid, d in grid_layout(m, n):
+            if to_iid is None:
+                if owns is not None and not owns(iid):
+                    continue
+                io = Intersection(iid, self)
+                io.set_position(pos_x, pos_y)
+                for d, nb_iid in enumerate(grid_neighbours(iid, m)):
+                    io.assign_from_iid(d, nb_iid)
+                    io.assign_to_iid(d, nb_iid)
+            else:
+                io = Inlet(iid, to_iid, d)
+                io.set_position(pos_x, pos_y)
+                self.inlets.append(io)
+            self.intersections[iid] = io
 
+    # Events with the same ts and type are handled in the order they were added
     def add_event(self, ev_type, ts, valid, payload):
-        ev = [ts, ev_type, payload, valid]
-        # Special procedure for erasing outdated light_change events (and adding new ones)
+        if not valid:
+            return
+        # Popped timestamps never decrease as long as nothing is scheduled in the past
+        if ts < self.last_event_ts:
+            raise ValueError("event {} at {} scheduled before the current time {}".format(
+                ev_type, ts, self.last_event_ts))
+        if self.canonical_order:
+            seq = self.canonical_seq(ev_type, payload)
+        else:
+            seq = self.next_seq
+            self.next_seq = seq + 1
+        # A new light change supersedes the pending one of the same intersection.
+        # The old event stays queued and is dropped by event_loop when popped.
         if ev_type == EV_LIGHT_CHANGE:
-            for i in self.marking:
-                if i[1] == EV_LIGHT_CHANGE:
-                    if i[2][1] == ev[2][1]:  # check intersection numbers
-                        i[3] = False
-                        self.marking.remove(i)
-            self.marking.append(ev)
-        heapq.heappush(self.events, ev)
-
-    def print_event(self, ev):
-        fmt = EVENT_FORMAT_STRINGS[ev[1]]
-        # Time and event_string
-        msg = "{:-3d}: ".format(ev[0]) + fmt.format(*ev[2])
-        for d in range(16, -1, -1):
-            msg = msg.replace('direction{}'.format(d), DIRECTION_NAMES[d % 4])
-        if self.pdata and ev[2][1] == 16:
-            print(msg)
+            self.light_change_tokens[payload[1]] = seq
+        self.events.push(Event(ts, ev_type, seq, payload))
+
+    # Tie-breaker that only depends on the event itself, so that the order of events does
+    # not depend on the order intersections added them in: a car only has one move
+    # pending, an intersection one light change (the others are superseded) and the
+    # dequeues of a queue are interchangeable.
+    def canonical_seq(self, ev_type, payload):
+        if ev_type == EV_CAR_ENTER_INTERSECTION:
+            return payload[0]
+        if ev_type == EV_LIGHT_CHANGE:
+            iid = payload[1]
+            n = self.light_changes_added.get(iid, 0) + 1
+            self.light_changes_added[iid] = n
+            return iid, n
+        if ev_type == EV_DEQUEUE_GREEN:
+            return payload[1], payload[2]
+        return 0
+
+    # Adds an arrival process (see arrivals.py), only its next arrival is ever scheduled
+    def add_arrivals(self, source):
+        self.arrival_sources.append(iter(source))
+        self.open_sources += 1
+        self.schedule_next_arrival(len(self.arrival_sources) - 1)
+
+    def schedule_next_arrival(self, index):
+        arrival = next(self.arrival_sources[index], None)
+        if arrival is None:
+            self.arrival_sources[index] = None
+            self.open_sources -= 1
+            if self.open_sources == 0 and self.wait_for_arrivals:
+                self.num_cars = self.cars_spawned
+            return
+        ts, cid, to_iid, to_dir = arrival
+        self.cars_spawned += 1
+        # Same event as any other car entering an intersection, the extra payload field
+        # tells efn_enter_intersection to pull the next arrival
+        self.add_event(EV_CAR_ENTER_INTERSECTION, ts, True, (cid, to_iid, to_dir, index))
 
     # this might be a short function but it's the method that makes this whole thing run
     def event_loop(self):
+        if self.profiler is not None:
+            return self.profiler.run(self)
+        self.run_events()
+
+    # Handles the events in order until num_cars cars left the grid, EV_ALL_STOP or the
+    # first event at until or later, which stays queued. handlers replaces event_handlers,
+    # e.g. with wrappers measuring them. on_event(ts, ev_type, seq, done) is called after
+    # every handler, done when the car left the grid.
+    def run_events(self, handlers=None, until=None, on_event=None):
+        if handlers is None:
+            handlers = self.event_handlers
+        if until is not None:
+            self.add_event(EV_ALL_STOP, until, True, None)  # Sorts before the events at until
         cars_finish = 0
+        pop = self.events.pop
+        tokens = self.light_change_tokens
+        trace = self.trace
         while cars_finish < self.num_cars:
-            ev = heapq.heappop(self.events)
-            if ev[1] == EV_ALL_STOP: break
-            if not ev[3]:
+            ts, ev_type, seq, payload = pop()
+            if ev_type == EV_ALL_STOP: break
+            if ev_type == EV_LIGHT_CHANGE and tokens[payload[1]] != seq:
+                self.stale_light_changes += 1  # Superseded by a later light change
                 continue
-            if self.pdata:
-                self.print_event(ev)
-            self.last_event_ts = ev[0]
-            fn = self.event_handlers[ev[1]]
+            if trace is not None:
+                trace.event(ts, ev_type, payload)
+            self.last_event_ts = ts
+            fn = handlers[ev_type]
             if fn is not None:
-                if fn(ev[0], ev[2]): cars_finish += 1
+                done = fn(ts, payload)
+                if done: cars_finish += 1
+                if on_event is not None:
+                    on_event(ts, ev_type, seq, done)
 
-    # Payload is [cid, toIID, direction]
+    # Payload is [cid, toIID, direction] (+ arrival process index for new cars)
     def efn_enter_intersection(self, ts, payload):
         cid = payload[0]
+        if len(payload) > 3:
+            self.car_entry_ts[cid] = ts
+            self.schedule_next_arrival(payload[3])
         to_iid = payload[1]
         d = payload[2]
         iso = self.intersections[to_iid]
         if type(iso) is Inlet:
+            # Car exits from the grid
             if self.choreographer:
                 self.choreographer.car_intersection_event(ts, cid, to_iid, d, -1)
+            self.finalize_car(ts, cid)
             return 1
-            # Car exits from the grid
         else:
             od, state = iso.incoming_traffic(ts, d, cid)
             if self.choreographer:
                 self.choreographer.car_intersection_event(ts, cid, to_iid, d, od, state)
 
+    # The car left the grid: fold it into the aggregates and drop everything kept for it
+    def finalize_car(self, ts, cid):
+        self.cars_exited += 1
+        entry_ts = self.car_entry_ts.pop(cid, None)
+        if entry_ts is not None:
+            self.trip_times.add(ts - entry_ts)
+        self.car_last_stop.pop(cid, None)
+        self.rng.forget(cid)
+
     # This event only for intersections with car waiting
     # Payload is [to_light_state, IID]
     def efn_light_change(self, ts, payload):
@@ -350,8 +517,9 @@ class TrafficGrid:
         iid = payload[1]
         qid = payload[2]
         iso = self.intersections[iid]
-        iso.dequeue_green(ts, cid, qid)
-        if self.choreographer:
+        item = iso.dequeue_green(ts, cid, qid)
+        if self.choreographer and item is not None:
+            cid = item[1]
             n_from = iso.n_from
             id = qid % n_from
             od = int(qid / n_from)  # od is out_going direction
@@ -365,77 +533,160 @@ class Statistics:
     num_cars = 100  # number of cars in the system
     grid_size = 3  # number of intersections in square grid
     car_density = 10  # change density of cars by changing enter time
-    counter = 0
-    total_wait_time = 0
-    wait_time_list = []
+    event_queue = HeapEventQueue  # or CalendarEventQueue, all timestamps are integers
+    workers = 1  # > 1 runs the replications in that many processes
+    seed = None  # master seed, every replication gets its own seed derived from it
+    batch_size = 10  # replications per task handed to a worker
+    # Sequential stopping: when set, runs are added until the confidence interval of the
+    # mean wait time is narrower than +-target_half_width, list_number is then the budget
+    target_half_width = None
+    confidence = 0.95
+    min_runs = 10
+    light_state_class = None  # None uses TrafficGrid's default light
+    # Each replication draws from a KeyedRandom seeded with its seed, so every car gets the
+    # same arrival and turns whatever the light policy (see policy_comparison.py)
+    common_random_numbers = False
+    trajectory_sample_rate = 1.0  # Fraction of the cars whose trajectory is kept
+    canonical_order = False  # Runs give the same results as partitioned ones (partitioned.py)
+
+    def __init__(self):
+        self.counter = 0
+        self.total_wait_time = 0
+        self.results = RunningStats()  # average wait time of every run
+        self.converged = None  # Whether the target half-width was reached
 
     def test(self):
-        while self.counter < self.list_number:  # 2 -> program runs 2 consecutive times
-            self.master_run()
-        if self.pdata:
-            print(self.wait_time_list)
-            x = 0
-            while x < self.list_number:
-                print(self.wait_time_list[x])
-                x += 1
-        print("Total wait time in %d runs:" % self.list_number, self.total_wait_time)
-
-        self.wait_time_list.sort()
-
-        print("Minimum:", self.wait_time_list[0])
-        print("Maximum:", self.wait_time_list[self.list_number - 1])
-        arithmetic_mean = self.total_wait_time / self.list_number
-        print("Mean:", arithmetic_mean)
-
-        print("Median:", statistics.median(self.wait_time_list))
-
-        try:
-            print("Standard Deviation:",
-                  statistics.stdev(self.wait_time_list, arithmetic_mean))
-        except statistics.StatisticsError:
-            print("Standard Deviation: N/A")
+        if self.target_half_width is not None:
+            self.run_until_converged()
+        elif self.workers > 1 or self.seed is not None:
+            self.run_replications(self.list_number - self.counter)
+        else:
+            while self.counter < self.list_number:  # 2 -> program runs 2 consecutive times
+                self.master_run()
+        self.report()
+
+    def make_pool(self):
+        if self.workers > 1:
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return nullcontext()
+
+    def run_until_converged(self):
+        master_seed = self.seed if self.seed is not None else random.getrandbits(64)
+        # In parallel every worker gets a batch per round, serially runs are added one by one
+        step = self.workers * self.batch_size if self.workers > 1 else 1
+        self.converged = False
+        with self.make_pool() as pool:
+            # Checked after every round too, the last one of the budget may converge
+            while True:
+                if self.counter >= self.min_runs:
+                    half_width = self.results.half_width(self.confidence)
+                    if half_width is not None and half_width <= self.target_half_width:
+                        self.converged = True
+                        break
+                if self.counter >= self.list_number:
+                    break
+                count = min(step, self.list_number - self.counter)
+                self.run_replications(count, master_seed, pool)
+
+    # Runs count replications, each seeded from the master seed, so the results only
+    # depend on the seed and not on how many workers were used. Every batch of
+    # replications comes back as a RunningStats that is merged into the results.
+    def run_replications(self, count, master_seed=None, pool=None):
+        if master_seed is None:
+            master_seed = self.seed if self.seed is not None else random.getrandbits(64)
+        seeds = replication_seeds(master_seed, self.counter, count)
+        batches = [seeds[i:i + self.batch_size] for i in range(0, count, self.batch_size)]
+        if pool is None and self.workers > 1:
+            with self.make_pool() as pool:
+                self.run_batches(batches, pool)
+        else:
+            self.run_batches(batches, pool)
+
+    def run_batches(self, batches, pool):
+        if pool is not None:
+            for batch_results in pool.map(run_replication_batch, [self] * len(batches), batches):
+                self.add_results(batch_results)
+        else:
+            for batch in batches:
+                self.add_results(run_replication_batch(self, batch))
+
+    def report(self):
+        results = self.results
+        print("Total wait time in %d runs:" % results.count, self.total_wait_time)
+        print("Minimum:", results.min)
+        print("Maximum:", results.max)
+        print("Mean:", results.mean)
+        print("Median:", results.median())
+        stdev = results.stdev()
+        print("Standard Deviation:", stdev if stdev is not None else "N/A")
+        if self.converged is not None:
+            half_width = results.half_width(self.confidence)
+            if self.converged:
+                print("Replications needed:", results.count)
+            else:
+                print("Replications needed: more than %d (budget exhausted)" % results.count)
+            print("%g%% confidence interval: %s +- %s" % (self.confidence * 100, results.mean,
+                                                          half_width))
 
     def master_run(self):
+        self.add_result(self.simulate())
+
+    def add_result(self, average_wait_time):
+        self.total_wait_time += average_wait_time
+        self.results.add(average_wait_time)
+        self.counter += 1
+
+    def add_results(self, results):
+        self.total_wait_time += results.total
+        self.results.merge(results)
+        self.counter += results.count
+
+    # Demand of a run, override for other arrival distributions or demand profiles
+    def arrivals(self, tr):
+        return MergedArrivals(tr.inlets, self.num_cars, UniformGaps(self.car_density), tr.rng)
+
+    # Runs the simulation once and returns the average wait time
+    def simulate(self, rng=None):
         grid_size = self.grid_size
-        car_density = self.car_density
         pdata = self.pdata
 
-        tr = TrafficGrid(self.num_cars, pdata)
-        tr.choreographer = Choreographer(tr)
+        tr = TrafficGrid(self.num_cars, pdata, event_queue=self.event_queue(), rng=rng,
+                         light_state_class=self.light_state_class,
+                         canonical_order=self.canonical_order)
+        if self.trajectory_sample_rate > 0:
+            tr.choreographer = Choreographer(tr, self.trajectory_sample_rate)
         tr.generate_grid(grid_size, grid_size)
-        grid_size += 2
-        # In this 3x3 grid example:
-        #     1   2   3
-        #     |   |   |
-        #  5--6---7---8---9
-        #     |   |   |
-        # 10--11--12--13--14
-        #     |   |   |
-        # 15--16--17--18--19
-        #     |   |   |
-        #     21  22  23
-
-        last_ts = 0
-        inlet_array = []
-        for i in range(grid_size):
-            if i == 0 or i == grid_size - 1:
-                for j in range(1, grid_size - 1):
-                    inlet_array.append(i * grid_size + j)
-            else:
-                inlet_array.append(i * grid_size)
-                inlet_array.append((i + 1) * grid_size - 1)
-
-        for i in range(self.num_cars):
-            last_ts += random.randint(0, car_density)
-            inlet = tr.intersections[random.choice(inlet_array)]
-            tr.add_event(EV_CAR_ENTER_INTERSECTION,
-                         last_ts, True, (i, inlet.to_iid, inlet.to_dir))
+        tr.add_arrivals(self.arrivals(tr))
         tr.event_loop()
         average_wait_time = tr.total_wait_time / tr.count_waited
         if self.pdata: print("Finished. Average wait = {}".format(average_wait_time))
-        self.total_wait_time += average_wait_time
-        self.wait_time_list.append(average_wait_time)
-        self.counter += 1
+        return average_wait_time
+
+
+# Seed of replication k, computed on its own so that adding runs one at a time does not
+# draw the seeds of all the runs before again
+def replication_seed(master_seed, k):
+    return random.Random("{}:{}".format(master_seed, k)).getrandbits(64)
+
+
+# Seeds of replications first..first+count-1, replication k always gets the same seed
+def replication_seeds(master_seed, first, count):
+    return [replication_seed(master_seed, k) for k in range(first, first + count)]
+
+
+def run_replication(stats, seed):
+    if stats.common_random_numbers:
+        return stats.simulate(KeyedRandom(seed))
+    random.seed(seed)
+    return stats.simulate()
+
+
+# Worker for Statistics.run_replications (module level so it can be sent to a process)
+def run_replication_batch(stats, seeds):
+    results = RunningStats()
+    for seed in seeds:
+        results.add(run_replication(stats, seed))
+    return results
 
 
 if __name__ == "__main__":